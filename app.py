@@ -4,25 +4,38 @@ from datetime import datetime
 import io
 import json
 import os
+import queue
 import threading
 import time
+import uuid
 from os.path import splitext
 from functools import wraps
+import numpy as np
 from pydub import AudioSegment
+from werkzeug.datastructures import FileStorage
 from werkzeug.security import check_password_hash
 
+from lib.admission_handler import AdmissionController, AdmissionRejected
+from lib.audio_decode_handler import decode_audio, estimate_decoded_bytes
+from lib.audio_file_handler import queue_call_audio
 from lib.config_handler import create_main_config, create_detector_config
 from lib.database_handler import SQLiteDatabase
+from lib.extraction_cache_handler import ExtractionCache
+from lib.extraction_executor_handler import ExtractionExecutor
+from lib.job_queue_handler import JobQueue
+from lib.shared_state_handler import create_expiring_set
+from lib.spectrum_batch_handler import SpectrumBatcher
+from lib.split_buffer_handler import SplitCallBuffer
 from lib.logging_handler import CustomLogger
 from flask import Flask, request, session, redirect, url_for, render_template, flash, jsonify
 
-from lib.tone_detection_handler import ToneDetection
-from lib.tone_extraction_handler import ToneExtraction
+from lib.tone_detection_handler import DetectorIndex, ToneDetection
+from lib.tone_extraction_handler import ToneExtraction, analysis_rate
 
 app_name = "icad_tone_detection"
 config_data = {}
 detector_data = {}
-qc_detector_list = []
+detector_index = None
 root_path = os.getcwd()
 config_file = 'config.json'
 detector_file = 'detectors.json'
@@ -84,6 +97,7 @@ def load_configuration():
 
 def load_detectors():
     global detector_data
+    global detector_index
 
     try:
         with open(detector_path, 'r') as f:
@@ -105,6 +119,8 @@ def load_detectors():
         return {'success': False, 'alert': {'type': 'danger',
                                             'message': f'Detector configuration file {detector_file} is not in valid JSON format.'}}
     else:
+        # Tone ranges of every detector, so matching doesn't walk each of them per upload
+        detector_index = DetectorIndex(detector_data)
         logger.info(f'Successfully loaded detector configuration from {detector_file}')
         return {'success': True,
                 'alert': {'type': 'danger',
@@ -119,7 +135,9 @@ if not config_loaded.get("success", False):
 
 detector_loaded = load_detectors()
 
-pending_audio_files = {}
+# Kept on the shared state backend so every worker sees them: detector ids that matched recently, each ignored
+# for its detector's ignore_time.
+ignored_detectors = create_expiring_set(config_data, "detectors")
 
 if not detector_loaded.get("success", False):
     exit(1)
@@ -130,6 +148,40 @@ try:
 except Exception as e:
     logger.error(f'Error while <<connecting>> to the <<database:>> {e}')
 
+# Extraction runs in a process pool when enabled, max_workers 0 uses every core.
+extraction_executor = None
+if config_data.get("extraction_executor", {}).get("enabled", 0) == 1:
+    extraction_executor = ExtractionExecutor(config_data["extraction_executor"].get("max_workers", 0))
+
+# Concurrent in-process extractions share batched FFTs when enabled.
+spectrum_batcher = None
+if config_data.get("spectrum_batching", {}).get("enabled", 0) == 1:
+    spectrum_batcher = SpectrumBatcher(config_data["spectrum_batching"].get("max_batch", 32),
+                                       config_data["spectrum_batching"].get("max_wait_ms", 5),
+                                       config_data["spectrum_batching"].get("workers", -1),
+                                       config_data["spectrum_batching"].get("timeout_ms", 5000))
+
+# Repeat uploads (retries, simulcast, split re-submissions) reuse earlier extraction results when enabled.
+extraction_cache = None
+if config_data.get("extraction_cache", {}).get("enabled", 0) == 1:
+    extraction_cache = ExtractionCache(config_data["extraction_cache"].get("max_entries", 512),
+                                       config_data["extraction_cache"].get("ttl", 3600),
+                                       config_data["extraction_cache"].get("sqlite_path", ""))
+
+# Synchronous uploads processed at once and the decoded audio they hold are capped when enabled, past that they
+# wait (priority talkgroups first) or are turned away with 429.
+admission = None
+if config_data.get("admission_control", {}).get("enabled", 0) == 1:
+    admission = AdmissionController(config_data["admission_control"].get("max_concurrent", 4),
+                                    config_data["admission_control"].get("max_decoded_bytes", 268435456),
+                                    config_data["admission_control"].get("max_waiting", 32),
+                                    config_data["admission_control"].get("max_wait", 10),
+                                    config_data["admission_control"].get("retry_after", 5))
+
+# Uploads the tonal energy pre-screen let through to full extraction or skipped as tone-free.
+pre_screen_stats = {"passed": 0, "skipped": 0}
+pre_screen_lock = threading.Lock()
+
 app = Flask(__name__)
 
 try:
@@ -144,25 +196,68 @@ except FileNotFoundError:
 app.static_folder = 'static'
 
 
-# Loop to run that clears old detections.
-def clear_old_items():
-    global qc_detector_list
-    while True:
-        time.sleep(1)
-        current_time = time.time()
-        if len(qc_detector_list) < 1:
-            continue
+def extraction_options(call_data):
+    """ToneExtraction keyword arguments for a call, what the head scan needs to know about where it came from."""
+    if config_data["tone_extraction"].get("head_scan", {}).get("enabled", 0) != 1:
+        return {}
+    return {"talkgroup": call_data.get("talkgroup"),
+            "sequential_quick_call": bool(detector_index.sequential.any())}
 
-        original_length = len(qc_detector_list)
 
-        qc_detector_list = [detector for detector in qc_detector_list if
-                            current_time < (detector["last_detected"] + detector["ignore_seconds"])]
+def is_priority(call_data):
+    """Whether a call comes from a talkgroup flagged high priority, processed ahead of the rest under load."""
+    return str(call_data.get("talkgroup")) in {str(talkgroup) for talkgroup in
+                                               config_data["upload_processing"].get("priority_talkgroups", [])}
 
-        removed_detectors = original_length - len(qc_detector_list)
-        if removed_detectors > 0:
-            logger.info(f"Ignored expired on {removed_detectors} detectors")
-        else:
-            logger.debug(f"{len(qc_detector_list)} detectors being ignored")
+
+def decode_upload(file):
+    file.stream.seek(0)
+    return decode_audio(file.stream, analysis_rate(config_data))
+
+
+def finish_detection(detection_data, audio_segment):
+    """Runs a call with tones through the detectors and saves its audio, per detection_mode."""
+    file_name = f'{round(detection_data["timestamp"], -1)}_detection'
+    local_audio_path = os.path.join(root_path, f"{audio_path}/{file_name}.mp3")
+    # Segments are rendered from the call's PCM, writing it takes no encode. The call's mp3 is encoded in the
+    # background once detection is done. Calls starting within the same ten seconds share file_name, the working
+    # audio has a name of its own so the encoder never removes or reads another call's.
+    working_audio_path = os.path.join(root_path, f"{audio_path}/{file_name}_{uuid.uuid4().hex}.wav")
+    audio_segment.export(working_audio_path, format='wav')
+    detection_data["local_audio_path"] = working_audio_path
+
+    if config_data["general"].get("detection_mode", 0) in (2, 3):
+        logger.warning("Processing Tones Through Detectors")
+
+        logger.debug("Processing QuickCall Tones")
+        _, detection_data = ToneDetection(config_data, detector_data, ignored_detectors, detection_data,
+                                          detector_index, audio_segment).detect_quick_call()
+
+    # Segments rendered untrimmed already hold the whole call, it isn't encoded a second time
+    whole_call_rendered = (isinstance(detection_data, list) and len(detection_data) > 0 and
+                           config_data["audio_processing"]["trim_tones"] != 1)
+    if isinstance(detection_data, dict):
+        detection_data["local_audio_path"] = local_audio_path
+    queue_call_audio(config_data, working_audio_path, None if whole_call_rendered else local_audio_path)
+
+    if config_data["general"].get("detection_mode", 0) in (1, 3):
+        with open(local_audio_path.replace(".mp3", ".json"), 'w+') as outjs:
+            outjs.write(json.dumps(detection_data, indent=4))
+
+    return detection_data
+
+
+def flush_split_call(talkgroup, pending):
+    """Runs the first half of a split call through detection on its own, nothing followed it in time."""
+    logger.warning(f"No more audio for talkgroup {talkgroup}, processing the pending call on its own.")
+    try:
+        finish_detection(pending["detection_data"], pending["audio"])
+    except Exception as e:
+        logger.error(f"Processing pending call for talkgroup {talkgroup} <<failed:>> {e}")
+
+
+# The first half of split calls waiting for the rest by talkgroup, on the shared state backend.
+pending_audio_files = SplitCallBuffer(config_data, flush_split_call)
 
 
 def login_required(f):
@@ -234,7 +329,6 @@ def logout():
 
 @app.route('/tone_detect', methods=['POST'])
 def tone_upload():
-    global qc_detector_list
     logger.info("Got New HTTP request.")
 
     if request.method != "POST":
@@ -257,33 +351,152 @@ def tone_upload():
     if ext not in allowed_extensions:
         return jsonify({"status": "error", "message": "File must be an MP3, WAV, or M4A"}), 400
 
-    file_data = file.read()
-    audio_segment = AudioSegment.from_file(io.BytesIO(file_data))
+    if job_queue is not None:
+        # Processed in the background, the recorder only waits for the upload to be queued
+        # Only the configured callback is ever called, a URL from the upload would let anyone point the server at
+        # any host it can reach
+        if call_data_post.pop("callback_url", None):
+            logger.warning("Ignoring the callback_url sent with the upload, only async_jobs.callback_url is used.")
+        upload = FileStorage(stream=io.BytesIO(file.read()), filename=file.filename)
+        try:
+            job_id = job_queue.submit((call_data_post, upload), config_data["async_jobs"].get("callback_url") or None,
+                                      is_priority(call_data_post))
+        except queue.Full:
+            logger.warning("Job queue full, rejecting upload.")
+            return jsonify({"status": "error", "message": "Job queue full"}), 429, {
+                "Retry-After": str(config_data["async_jobs"].get("retry_after", 5))}
+        logger.info(f"HTTP Request Queued as job {job_id}")
+        return jsonify({"status": "accepted", "job_id": job_id,
+                        "status_url": url_for('job_status', job_id=job_id)}), 202
+
+    if admission is None:
+        result, status_code = process_upload(call_data_post, file)
+    else:
+        cost = estimate_decoded_bytes(file.stream, analysis_rate(config_data),
+                                      config_data["admission_control"].get("compressed_kbps", 16))
+        try:
+            with admission.admit(is_priority(call_data_post), cost):
+                result, status_code = process_upload(call_data_post, file)
+        except AdmissionRejected as e:
+            logger.warning(f"Upload rejected: {e}")
+            return jsonify({"status": "error", "message": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    logger.info("HTTP Request Completed")
+    return jsonify(result), status_code
+
+
+@app.route('/tone_detect/<job_id>', methods=['GET'])
+def job_status(job_id):
+    if job_queue is None:
+        return jsonify({"status": "error", "message": "Async jobs disabled"}), 404
+    record = job_queue.get(job_id)
+    if record is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(record), 200
+
+
+def process_upload(call_data_post, file):
+    """
+    Extracts tones from an upload and runs them through split handling, export and the detectors.
+
+    Args:
+        call_data_post (dict): Form data of the upload.
+        file: Uploaded file, anything with the stream and filename of a werkzeug FileStorage.
+
+    Returns:
+        tuple: (response data, HTTP status code)
+    """
+    # A cache hit skips decoding, samples are only decoded later if split handling needs them.
+    options = extraction_options(call_data_post)
+    extraction_settings = dict(config_data["tone_extraction"], **options)
+    cache_key = None
+    cached = None
+    if extraction_cache is not None:
+        cache_key = extraction_cache.make_key(file.stream, extraction_settings)
+        cached = extraction_cache.get(cache_key)
+
+    samples = None
+    if cached is not None:
+        logger.debug("Extraction cache hit for upload.")
+        duration = cached[1]
+    else:
+        try:
+            samples, sample_rate, duration = decode_upload(file)
+        except Exception as e:
+            logger.error(f"Unable to decode uploaded audio: {e}")
+            return {"status": "error", "message": f"Exception while decoding audio. {e}"}, 500
 
-    if audio_segment.duration_seconds < config_data["upload_processing"].get("minimum_audio_length", 4.5):
+    if duration < config_data["upload_processing"].get("minimum_audio_length", 4.5):
         logger.warning("Audio Too Short Discarding")
-        return jsonify({"status": "error", "message": "Audio too short."}), 200
+        return {"status": "error", "message": "Audio too short."}, 200
+
+    # Only built from the upload when tones are found and the audio has to be exported
+    audio_segment = None
+    # First half of a split call this upload is the rest of, the stitched audio is built with audio_segment
+    stitch_audio = None
+    # Per frame frequencies already found for the start of samples, and how many samples they cover
+    known = {}
 
     if config_data["upload_processing"].get("check_for_split", 0) == 1:
         talkgroup = call_data_post.get('talkgroup')
         if not talkgroup:
-            return jsonify({"status": "error", "message": "Talkgroup is required"}), 400
-        if talkgroup in pending_audio_files:
-            if int(pending_audio_files[talkgroup]["call_data"].get("start_time", time.time())) - int(call_data_post.get("start_time")) < config_data["upload_processing"].get("maximum_split_interval", 30):
+            return {"status": "error", "message": "Talkgroup is required"}, 400
+        # Taken off the backend as one step, so only one worker stitches it
+        pending = pending_audio_files.take(talkgroup)
+        if pending is not None:
+            if int(pending["call_data"].get("start_time", time.time())) - int(call_data_post.get("start_time")) < config_data["upload_processing"].get("maximum_split_interval", 30):
                 #found a previous segment of audio with tones that happened within 30 seconds of this one.
                 logger.warning("Found previous detection, with no dispatch. Appending...")
                 # Append 2 seconds of silence and then the new audio
-                silence = AudioSegment.silent(duration=2000)
-                pending_audio_files[talkgroup]["audio"] += silence + audio_segment
-                pending_audio_files[talkgroup]["length"] += audio_segment.duration_seconds / 1000  # length in seconds
-
-                audio_segment = pending_audio_files[talkgroup]["audio"]
-                call_data_post = pending_audio_files[talkgroup]["call_data"]
-                call_data_post['call_length'] = str(pending_audio_files[talkgroup]["length"])
-            del pending_audio_files[talkgroup]  # Remove the entry as it's no longer pending
+                if samples is None:
+                    samples, sample_rate, duration = decode_upload(file)
+                stitch_audio = pending["audio"]
+                # Frames over the first half and the silence were analysed with it, only the new audio is
+                known = {"known_frequencies": pending.get("frequencies"),
+                         "known_samples": len(pending["samples"]) + 2 * sample_rate}
+                pending["samples"] = np.concatenate(
+                    (pending["samples"], np.zeros(2 * sample_rate, dtype=np.float32), samples))
+                pending["length"] += duration / 1000  # length in seconds
+
+                samples = pending["samples"]
+                duration = len(samples) / sample_rate
+                call_data_post = pending["call_data"]
+                call_data_post['call_length'] = str(pending["length"])
+
+                # The stitched audio is new content, look it up by its samples instead
+                cached = None
+                if extraction_cache is not None:
+                    cache_key = extraction_cache.make_key(samples, extraction_settings)
+                    cached = extraction_cache.get(cache_key)
+            else:
+                # Full detection of the earlier call runs on its own thread, not in this request
+                pending_audio_files.flush(talkgroup, pending)
 
+    # Per frame frequencies of this extraction, kept with the call if it waits for the rest of a split call
+    frame_frequencies = None
     try:
-        quick_call, hi_low, long_tone, dtmf_tone = ToneExtraction(config_data, audio_segment).main()
+        if cached is not None:
+            quick_call, hi_low, long_tone, dtmf_tone = cached[0]
+        else:
+            tone_free = False
+            if config_data["tone_extraction"].get("pre_screen", {}).get("enabled", 0) == 1:
+                tone_free = not ToneExtraction(config_data).has_tonal_energy(samples, sample_rate)
+                with pre_screen_lock:
+                    pre_screen_stats["skipped" if tone_free else "passed"] += 1
+
+            if tone_free:
+                logger.debug("Pre-screen found no tonal energy, skipping extraction.")
+                quick_call, hi_low, long_tone, dtmf_tone = [], [], [], []
+            elif extraction_executor is not None:
+                (quick_call, hi_low, long_tone, dtmf_tone), frame_frequencies = extraction_executor.extract(
+                    config_data, samples, sample_rate, **options, **known)
+            else:
+                extraction = ToneExtraction(config_data, samples=samples, sample_rate=sample_rate,
+                                            spectrum_batcher=spectrum_batcher, **options, **known)
+                quick_call, hi_low, long_tone, dtmf_tone = extraction.main()
+                frame_frequencies = extraction.frame_frequencies
+            if extraction_cache is not None:
+                extraction_cache.put(cache_key, (quick_call, hi_low, long_tone, dtmf_tone), duration)
+
         detection_data = {
             "quick_call": quick_call,
             "hi_low": hi_low,
@@ -301,7 +514,7 @@ def tone_upload():
         }
 
     except Exception as e:
-        return jsonify({"status": "error", "message": f"Exception while extracting tones. {e}"}), 500
+        return {"status": "error", "message": f"Exception while extracting tones. {e}"}, 500
 
     if not (quick_call or hi_low or long_tone or dtmf_tone):
         logger.debug(f"No tones found in audio. {quick_call} {hi_low} {long_tone} {dtmf_tone}")
@@ -310,34 +523,40 @@ def tone_upload():
 
         logger.debug(detection_data.get("quick_call"))
 
+        if audio_segment is None:
+            file.stream.seek(0)
+            audio_segment = AudioSegment.from_file(file.stream)
+            if stitch_audio is not None:
+                audio_segment = stitch_audio + (AudioSegment.silent(duration=2000) + audio_segment)
+
         if config_data["upload_processing"].get("check_for_split") == 1:
             # files less than 30 seconds with tones, get sent to list to wait for second half.
-            if audio_segment.duration_seconds < config_data["upload_processing"].get("maximum_split_length", 30):
+            if duration < config_data["upload_processing"].get("maximum_split_length", 30):
                 logger.warning(f'Audio with tones less than {config_data["upload_processing"].get("maximum_split_length", 30)} seconds. Waiting for next file.')
-                pending_audio_files[talkgroup] = {"call_data": call_data_post, "audio": audio_segment,
-                                                  "length": audio_segment.duration_seconds / 1000, "timestamp": time.time()}
-                return jsonify({"status": "pending", "message": "Waiting for more audio"}), 200
-
-        file_name = f'{round(detection_data["timestamp"], -1)}_detection'
-        local_audio_path = os.path.join(root_path, f"{audio_path}/{file_name}.mp3")
-        audio_segment.export(local_audio_path, format='mp3')
-        detection_data["local_audio_path"] = local_audio_path
+                if samples is None:
+                    samples, sample_rate, duration = decode_upload(file)
+                pending_audio_files.put(talkgroup, {"call_data": call_data_post, "detection_data": detection_data,
+                                                    "audio": audio_segment, "samples": samples,
+                                                    "frequencies": frame_frequencies, "length": duration / 1000,
+                                                    "timestamp": time.time()})
+                return {"status": "pending", "message": "Waiting for more audio"}, 200
 
-        if config_data["general"].get("detection_mode", 0) in (2, 3):
-            logger.warning("Processing Tones Through Detectors")
+        detection_data = finish_detection(detection_data, audio_segment)
 
-            logger.debug("Processing QuickCall Tones")
-            qc_result, processed_detection_data = ToneDetection(config_data, detector_data, qc_detector_list, detection_data).detect_quick_call()
+    return detection_data, 200
 
-            qc_detector_list = qc_result
-            detection_data = processed_detection_data
 
-        if config_data["general"].get("detection_mode", 0) in (1, 3):
-            with open(local_audio_path.replace(".mp3", ".json"), 'w+') as outjs:
-                outjs.write(json.dumps(detection_data, indent=4))
-
-    logger.info("HTTP Request Completed")
-    return jsonify(detection_data), 200
+@app.route('/stats', methods=['GET'])
+@login_required
+def stats():
+    return jsonify({
+        "extraction_cache": extraction_cache.stats() if extraction_cache is not None else None,
+        "spectrum_batching": spectrum_batcher.stats() if spectrum_batcher is not None else None,
+        "split_buffer": pending_audio_files.stats(),
+        "jobs": job_queue.stats() if job_queue is not None else None,
+        "admission": admission.stats() if admission is not None else None,
+        "pre_screen": dict(pre_screen_stats)
+    }), 200
 
 
 @app.route('/save_main_config', methods=['POST'])
@@ -599,7 +818,17 @@ def import_ttd():
     return redirect(url_for("admin_detector_config"), code=302)
 
 
-threading.Thread(target=clear_old_items, daemon=True).start()
+if extraction_executor is not None:
+    threading.Thread(target=extraction_executor.start, daemon=True).start()
+
+# Uploads are answered with a job id and processed in the background when enabled, see job_status.
+job_queue = None
+if config_data.get("async_jobs", {}).get("enabled", 0) == 1:
+    job_queue = JobQueue(process_upload, create_expiring_set(config_data, "jobs"),
+                         config_data["async_jobs"].get("workers", 2),
+                         config_data["async_jobs"].get("max_queue", 64),
+                         config_data["async_jobs"].get("result_ttl", 3600),
+                         config_data["async_jobs"].get("callback_timeout", 10))
 
 # if __name__ == '__main__':
 #     app.run(host="0.0.0.0", port=8002, debug=False)
@@ -0,0 +1,110 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+module_logger = logging.getLogger('icad_tone_detection.admission')
+
+
+class AdmissionRejected(Exception):
+    """An upload couldn't be admitted in time, the client should retry after retry_after seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Caps the uploads processed at once and the decoded audio they hold between them, so a burst of uploads during
+    a regional incident queues up instead of decoding and analysing all at once.
+
+    An upload is admitted while fewer than max_concurrent are in flight and its (estimated) decoded bytes fit
+    within max_decoded_bytes alongside theirs; one upload on its own is always admitted, however big. Otherwise
+    it waits, at most max_waiting uploads for at most max_wait seconds each. Waiting uploads are admitted priority
+    ones (fire dispatch talkgroups, ...) first, then in arrival order. Uploads that find the wait queue full or
+    run out of time are rejected with AdmissionRejected.
+    """
+
+    def __init__(self, max_concurrent=4, max_decoded_bytes=268435456, max_waiting=32, max_wait=10, retry_after=5):
+        self.max_concurrent = max_concurrent
+        self.max_decoded_bytes = max_decoded_bytes
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.decoded_bytes = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.waited = 0
+        # (rank, arrival) of every waiting upload, rank 0 for priority uploads
+        self._waiting = []
+        self._arrivals = itertools.count()
+        self._condition = threading.Condition()
+
+    def _fits(self, cost):
+        return self.in_flight < self.max_concurrent and (
+                self.in_flight == 0 or self.decoded_bytes + cost <= self.max_decoded_bytes)
+
+    @contextmanager
+    def admit(self, priority, cost):
+        """
+        Holds a place for an upload while the with block processes it.
+
+        Args:
+            priority (bool): Admit the upload ahead of every waiting upload that isn't a priority one.
+            cost (int): Decoded bytes the upload is expected to hold.
+
+        Raises:
+            AdmissionRejected: The wait queue was full or the upload waited max_wait seconds.
+        """
+        self._acquire(priority, cost)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self.decoded_bytes -= cost
+                self._condition.notify_all()
+
+    def _acquire(self, priority, cost):
+        with self._condition:
+            if not self._waiting and self._fits(cost):
+                self._admit(cost)
+                return
+
+            if len(self._waiting) >= self.max_waiting:
+                self.rejected += 1
+                raise AdmissionRejected("Too many uploads waiting", self.retry_after)
+
+            entry = (0 if priority else 1, next(self._arrivals))
+            heapq.heappush(self._waiting, entry)
+            self.waited += 1
+            deadline = time.monotonic() + self.max_wait
+            while not (self._waiting[0] == entry and self._fits(cost)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self.rejected += 1
+                    # The upload behind this one may fit where it didn't
+                    self._condition.notify_all()
+                    raise AdmissionRejected("Timed out waiting for capacity", self.retry_after)
+                self._condition.wait(remaining)
+
+            heapq.heappop(self._waiting)
+            self._admit(cost)
+            # The next in line may fit as well
+            self._condition.notify_all()
+
+    def _admit(self, cost):
+        self.in_flight += 1
+        self.decoded_bytes += cost
+        self.admitted += 1
+
+    def stats(self):
+        with self._condition:
+            return {"in_flight": self.in_flight, "decoded_bytes": self.decoded_bytes, "waiting": len(self._waiting),
+                    "admitted": self.admitted, "waited": self.waited, "rejected": self.rejected}
@@ -0,0 +1,213 @@
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import threading
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+from scipy.io import wavfile
+
+from lib.tone_extraction_handler import resample_audio
+
+module_logger = logging.getLogger('icad_tone_detection.audio_decode')
+
+
+def is_wav(stream):
+    """Checks for a RIFF/WAVE header without consuming the stream."""
+    position = stream.tell()
+    header = stream.read(12)
+    stream.seek(position)
+    return len(header) == 12 and header[:4] == b'RIFF' and header[8:12] == b'WAVE'
+
+
+def wav_duration(stream):
+    """
+    Reads a WAV file's duration from its header without consuming the stream.
+
+    Returns:
+        float: Duration in seconds, None if the header can't tell.
+    """
+    start = stream.tell()
+    try:
+        stream.read(12)
+        byte_rate = None
+        while True:
+            header = stream.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = header[:4], struct.unpack('<I', header[4:])[0]
+            if chunk_id == b'data':
+                if not byte_rate:
+                    return None
+                if chunk_size in (0, 0xFFFFFFFF):
+                    # Written while streaming, the data runs to the end of the file
+                    data_start = stream.tell()
+                    chunk_size = stream.seek(0, os.SEEK_END) - data_start
+                return chunk_size / byte_rate
+            # Chunks are padded to an even size
+            body = stream.read(chunk_size + chunk_size % 2)
+            if chunk_id == b'fmt ' and len(body) >= 12:
+                byte_rate = struct.unpack('<I', body[8:12])[0]
+    finally:
+        stream.seek(start)
+
+
+def estimate_decoded_bytes(stream, rate, compressed_kbps=16):
+    """
+    Estimates the size of the samples decode_audio returns for an upload, without decoding it.
+
+    WAV durations come from the header. Other formats are assumed to be compressed at compressed_kbps, a low
+    bitrate for recorder audio, so the estimate errs high.
+
+    Args:
+        stream: Seekable binary file object positioned at the start of the upload.
+        rate (int): Sample rate the audio will be decoded at.
+        compressed_kbps (float): Bitrate assumed for compressed formats.
+
+    Returns:
+        int: Estimated bytes of float32 samples.
+    """
+    start = stream.tell()
+    size = stream.seek(0, os.SEEK_END) - start
+    stream.seek(start)
+
+    duration = wav_duration(stream) if is_wav(stream) else None
+    if duration is None:
+        duration = size * 8 / (compressed_kbps * 1000)
+    return int(duration * rate) * 4
+
+
+def decode_wav(stream, rate):
+    """
+    Reads PCM or float WAV data straight into NumPy, skipping ffmpeg entirely.
+
+    Args:
+        stream: Seekable binary file object positioned at the start of the WAV data.
+        rate (int): Sample rate to return the audio at.
+
+    Returns:
+        numpy.ndarray: Mono float32 samples scaled to [-1, 1] at rate.
+    """
+    file_rate, data = wavfile.read(stream)
+
+    if data.dtype == np.uint8:
+        samples = (data.astype(np.float32) - 128) / 128
+    elif np.issubdtype(data.dtype, np.integer):
+        samples = data.astype(np.float32) / 2 ** (data.dtype.itemsize * 8 - 1)
+    else:
+        samples = data.astype(np.float32, copy=False)
+
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1, dtype=np.float32)
+
+    return resample_audio(samples, file_rate, rate)
+
+
+def run_ffmpeg_decode(command, stream=None):
+    """
+    Runs an ffmpeg decode command, streaming stream to its stdin (if given) while reading f32le PCM from stdout.
+
+    Returns:
+        bytes: Raw PCM output, or None if ffmpeg failed.
+    """
+    stdin = subprocess.PIPE if stream is not None else subprocess.DEVNULL
+    with subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+        errors = []
+
+        def feed_input():
+            try:
+                shutil.copyfileobj(stream, proc.stdin, 65536)
+            except (BrokenPipeError, ValueError):
+                # ffmpeg stopped reading, the return code tells us why
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        def drain_errors():
+            errors.append(proc.stderr.read())
+
+        threads = [threading.Thread(target=drain_errors, daemon=True)]
+        if stream is not None:
+            threads.append(threading.Thread(target=feed_input, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        pcm = proc.stdout.read()
+        proc.wait()
+        for thread in threads:
+            thread.join()
+
+    if proc.returncode != 0 or not pcm:
+        module_logger.debug(f"ffmpeg decode failed with code {proc.returncode}: "
+                            f"{b''.join(errors).decode('utf-8', 'replace').strip()}")
+        return None
+    return pcm
+
+
+def decode_ffmpeg(stream, rate):
+    """
+    Decodes any ffmpeg readable audio to mono float32 samples at rate in a single ffmpeg process.
+
+    The upload is streamed to ffmpeg's stdin and the PCM it writes is wrapped with np.frombuffer, so the decoded
+    audio is only held once. Containers that need seeking (e.g. M4A with the index at the end) can't be read
+    from a pipe, those are spooled to a temporary file and decoded from there.
+
+    Args:
+        stream: Seekable binary file object positioned at the start of the upload.
+        rate (int): Sample rate to return the audio at.
+
+    Returns:
+        numpy.ndarray: Mono float32 samples (read-only) at rate.
+
+    Raises:
+        ValueError: If ffmpeg can't decode the audio.
+    """
+    output_args = ["-vn", "-ac", "1", "-ar", str(rate), "-f", "f32le", "pipe:1"]
+
+    start = stream.tell()
+    pcm = run_ffmpeg_decode(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0"] + output_args, stream)
+
+    if pcm is None:
+        stream.seek(start)
+        with NamedTemporaryFile() as temp_file:
+            shutil.copyfileobj(stream, temp_file, 65536)
+            temp_file.flush()
+            pcm = run_ffmpeg_decode(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", temp_file.name]
+                                    + output_args)
+
+    if pcm is None:
+        raise ValueError("ffmpeg could not decode audio")
+
+    return np.frombuffer(pcm, dtype=np.float32)
+
+
+def decode_audio(stream, rate):
+    """
+    Decodes an uploaded audio file to mono float32 samples at the analysis rate.
+
+    Args:
+        stream: Seekable binary file object (e.g. the upload's FileStorage.stream).
+        rate (int): Sample rate to return the audio at.
+
+    Returns:
+        tuple: (samples, rate, duration_seconds)
+    """
+    samples = None
+    if is_wav(stream):
+        start = stream.tell()
+        try:
+            samples = decode_wav(stream, rate)
+        except ValueError as e:
+            # Compressed WAV formats (ADPCM, mu-law, ...) need ffmpeg
+            module_logger.debug(f"WAV fast path unavailable, decoding with ffmpeg: {e}")
+            stream.seek(start)
+
+    if samples is None:
+        samples = decode_ffmpeg(stream, rate)
+
+    return samples, rate, len(samples) / rate
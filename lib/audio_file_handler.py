@@ -1,23 +1,78 @@
 import json
 import logging
+import os
 import re
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from shutil import copyfile
-from tempfile import TemporaryDirectory
 from typing import List
-from uuid import uuid4
 import traceback
 
+from lib.loudness_handler import measure_loudness, segment_samples
 from lib.shell_handler import run_command
 
 module_logger = logging.getLogger('icad_tone_detection.audio_file_handler')
 
+# Thread pools by name with their size, created on first use and shared by every call so the ffmpeg processes
+# running at once stay bounded: "render" renders the intervals of stacked dispatches side by side, "encode" encodes
+# full calls off the request path.
+pools = {}
+pools_lock = threading.Lock()
 
-def get_unique_file_path(temp_dir_path, suffix):
-    """Generates a unique file path within the specified directory with the given suffix."""
-    return f"{temp_dir_path}/{uuid4()}{suffix}"
+
+# Formats segments can be rendered to for the actions that deliver them, by name: (extension, ffmpeg output
+# options). Options that set -ar keep it, the others are given the call's own rate when normalizing.
+ARTIFACT_FORMATS = {
+    "mp3": ("mp3", []),
+    "opus": ("ogg", ["-ac", "1", "-strict", "-2", "-codec:a", "opus", "-b:a", "128k", "-ar", "48000"])
+}
+
+
+def get_pool(name, max_workers):
+    # A pool is replaced when a reloaded configuration changes its size. The old one isn't shut down, a caller may
+    # still be about to submit to it, its threads exit once their work is done and it's released.
+    max_workers = max(max_workers, 1)
+    with pools_lock:
+        if name not in pools or pools[name][1] != max_workers:
+            pools[name] = (ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name), max_workers)
+        return pools[name][0]
+
+
+def artifact_formats(config_data, matches):
+    """
+    Formats a segment with matches is rendered to: mp3, which is kept, and opus when the segment will be posted to
+    Telegram, which process_alert_actions only does for matches with post_to_telegram set.
+    """
+    formats = ["mp3"]
+    if (config_data.get("telegram_settings", {}).get("enabled", 0) == 1 and
+            any(match["detector_config"].get("post_to_telegram", 0) != 0 for match in matches)):
+        formats.append("opus")
+    return formats
+
+
+def artifact_map(mp3_path, formats):
+    """Path of a segment's audio in each of formats, next to its mp3."""
+    base_path = os.path.splitext(mp3_path)[0]
+    return {audio_format: f"{base_path}.{ARTIFACT_FORMATS[audio_format][0]}" for audio_format in formats}
+
+
+def get_artifact(detection_data, audio_format):
+    """
+    Path of a segment's audio in audio_format from its artifact map, None if it wasn't rendered to it. Segments
+    without an artifact map only have their mp3, at local_audio_path.
+    """
+    if "artifacts" in detection_data:
+        return detection_data["artifacts"].get(audio_format)
+    return detection_data.get("local_audio_path") if audio_format == "mp3" else None
+
+
+def remove_delivery_artifacts(detection_data):
+    """Removes the formats of a segment other than its mp3 once the actions delivering them are done."""
+    for audio_format, path in detection_data.get("artifacts", {}).items():
+        if audio_format != "mp3" and os.path.exists(path):
+            os.remove(path)
 
 
 def group_tones_by_time(tone_data: List[dict], time_gap: float) -> List[List[dict]]:
@@ -127,158 +182,158 @@ def extract_tone_times(detection_data, time_gap, post_cut_duration, pre_cut_dura
     return intervals, tone_ids_for_intervals
 
 
-def extract_audio_segment(input_file: str, start_time: float, end_time: float, output_file: str) -> bool:
+def segment_filter_chain(interval, filters="", loudnorm=None) -> str:
     """
-    Extracts a specific segment of an audio from the input file, using the given start and end times,
-    and then saves that segment to a specified output file. This function utilizes the ffmpeg command-line
-    tool to perform the extraction.
+    Builds the filter chain that renders one interval of a call: atrim to the interval, then the user's filters,
+    then loudnorm.
 
     Args:
-        input_file (str): The path to the input audio file from which to extract the segment.
-        start_time (float): The start time (in seconds) of the segment to extract.
-        end_time (float): The end time (in seconds) of the segment to extract. If None, extracts till the end of the file.
-        output_file (str): The path to save the output audio file.
+        interval (tuple): (start, end) in seconds, end None runs to the end of the call.
+        filters (str): The user's ffmpeg filter chain, empty for none.
+        loudnorm (str): loudnorm filter with its options, None to leave the level alone.
 
     Returns:
-        bool: True if the segment was successfully extracted and saved, otherwise False.
+        str: Comma separated filter chain.
     """
-
-    try:
-        # Initializing the command list with "ffmpeg" and the "-ss" option to specify the start time
-        command = [
-            "ffmpeg",
-            "-ss", str(start_time)
-        ]
-
-        # If an end time is provided, extending the command list with the "-to" option and the end time
-        if end_time is not None:
-            command.extend(["-to", str(end_time)])
-
-        # Extending the command list with the input file, the "-y" option to overwrite output files, and the output file
-        command.extend([
-            "-i", input_file,
-            "-y",
-            output_file
-        ])
-
-        # Running the command using subprocess and checking the return code to determine if the command was successful
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return True
-    except subprocess.CalledProcessError as e:
-        # Logging an error message if a CalledProcessError occurs (indicating the command failed)
-        module_logger.error(f"An error occurred while extracting audio segment: {e}")
-        return False
-    except Exception as e:
-        # Logging an error message if any other type of exception occurs
-        module_logger.error(f"An unexpected error occurred: {e}")
-        return False
-
-
-def normalize_audio(input_file: str, output_file: str):
+    trim = f"atrim=start={interval[0] or 0}"
+    if interval[1] is not None:
+        trim += f":end={interval[1]}"
+    chain = [trim, "asetpts=PTS-STARTPTS"]
+    if filters:
+        chain.append(filters)
+    if loudnorm:
+        chain.append(loudnorm)
+    return ",".join(chain)
+
+
+def run_segment_graph(input_file: str, chains: List[str], outputs: List[List[List[str]]],
+                      input_options: List[str] = None) -> subprocess.CompletedProcess:
     """
-    Analyzes and normalizes the audio level of the input file and writes the normalized audio to the output file.
-
-    This function uses ffmpeg to first analyze the loudness of the input audio file and then normalize the audio
-    based on the calculated parameters to meet the specified loudness standards.
+    Runs every filter chain over one decode of input_file in a single ffmpeg process, each into its own outputs.
 
     Args:
-        input_file (str): The path to the input audio file which needs to be normalized.
-        output_file (str): The path to save the normalized output audio file.
+        input_file (str): The path to the input audio file.
+        chains (List[str]): Filter chain per interval, see segment_filter_chain.
+        outputs (List[List[List[str]]]): ffmpeg arguments of every output of each chain, e.g. [["out.mp3"]] or
+                                         [["-f", "null", "-"]]. A chain is filtered once however many outputs
+                                         it has.
+        input_options (List[str]): ffmpeg options for the input, e.g. ["-ss", "30"].
 
     Returns:
-        bool: True if the audio was successfully normalized and saved, otherwise False.
-    """
-
-    try:
-        # Construct the command for analyzing the loudness of the audio using ffmpeg
-        analyze_command = [
-            "ffmpeg",
-            "-i", input_file,
-            "-af", "loudnorm=print_format=json",
-            "-f", "null",
-            "-"
-        ]
-
-        # Run the analyze command and extract loudnorm parameters from the output
-        result = subprocess.run(analyze_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        stderr_output = result.stderr.decode('utf-8')
-        lines = stderr_output.split('\n')
-
-        # Find the start and end index of the JSON formatted loudnorm parameters in the command output
-        json_start_index = next(i for i, line in enumerate(lines) if line.strip().startswith('{'))
-        json_end_index = next(i for i, line in enumerate(lines) if line.strip().endswith('}'))
-
-        # Extract and parse the loudnorm parameters JSON string
-        json_str = '\n'.join(lines[json_start_index:json_end_index + 1])
-        loudnorm_params = json.loads(json_str)
-
-    except Exception as e:
-        module_logger.error(f"An unexpected anyalize normalize error occurred: {e}")
-        traceback.print_exc()
-        return False
-
-    try:
-        # Construct the command for normalizing the audio using ffmpeg and the extracted loudnorm parameters
-        normalize_command = [
-            "ffmpeg",
-            "-i", input_file,
-            "-af",
-            f"loudnorm=I=-16:TP=-1.5:LRA=11:measured_I={loudnorm_params['input_i']}:measured_LRA={loudnorm_params['input_lra']}:measured_TP={loudnorm_params['input_tp']}:measured_thresh={loudnorm_params['input_thresh']}:offset={loudnorm_params['target_offset']}",
-            "-y",
-            output_file
-        ]
-
-        # Run the normalize command to create the normalized audio file
-        subprocess.run(normalize_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        return True
-    except subprocess.CalledProcessError as e:
-        traceback.print_exc()
-        module_logger.error(f"An error occurred while normalizing audio: {e}")
-        return False
-    except Exception as e:
-        module_logger.error(f"An unexpected normalize error occurred: {e}")
-        traceback.print_exc()
-        return False
+        subprocess.CompletedProcess: The finished ffmpeg run, its stderr holds what filters printed.
 
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg failed.
+    """
+    # asplit hands every chain its own copy of the decoded audio, and every output of a chain its own copy of the
+    # filtered audio
+    graph = []
+    if len(chains) > 1:
+        graph.append(f"[0:a]asplit={len(chains)}" + "".join(f"[in{index}]" for index in range(len(chains))))
+    command_outputs = []
+    for index, (chain, chain_outputs) in enumerate(zip(chains, outputs)):
+        labels = [f"[out{index}_{output_index}]" for output_index in range(len(chain_outputs))]
+        if len(labels) > 1:
+            chain += f",asplit={len(labels)}"
+        graph.append(("[0:a]" if len(chains) == 1 else f"[in{index}]") + chain + "".join(labels))
+        for label, output in zip(labels, chain_outputs):
+            command_outputs += ["-map", label] + output
+
+    command = ["ffmpeg", "-hide_banner", "-y"] + (input_options or []) + ["-i", input_file,
+                                                                        "-filter_complex", ";".join(graph)]
+    return subprocess.run(command + command_outputs, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def measure_loudness_ffmpeg(input_file: str, intervals: List[tuple], filters: str = "",
+                            input_options: List[str] = None) -> tuple:
+    """
+    Measures the loudness of every interval of a call (after the user's filters) for two pass loudnorm, decoding
+    the call once and encoding nothing. input_options are passed on to run_segment_graph.
 
-def apply_filters(input_file: str, output_file: str, filters: str) -> bool:
+    Returns:
+        tuple: loudnorm's measurements (input_i, input_lra, input_tp, input_thresh, target_offset) per interval, and
+               the call's sample rate (None if ffmpeg didn't report it).
     """
-    Applies the specified FFmpeg filters to the audio in the input file and saves the processed audio to the output file.
+    chains = [segment_filter_chain(interval, filters, "loudnorm=print_format=json") for interval in intervals]
+    result = run_segment_graph(input_file, chains, [[["-f", "null", "-"]]] * len(intervals), input_options)
+
+    # Each loudnorm prints its JSON when the graph closes, in no particular order. They're numbered in the order
+    # they appear in the graph, which is interval order.
+    stderr_output = result.stderr.decode('utf-8', 'replace')
+    blocks = re.findall(r"\[Parsed_loudnorm_(\d+) @ [^\]]*\]\s*(\{.*?\})", stderr_output, re.DOTALL)
+    if len(blocks) != len(intervals):
+        raise ValueError(f"Expected {len(intervals)} loudness measurements, ffmpeg printed {len(blocks)}")
+    sample_rate = re.search(r"Stream #0:\d+.*?: Audio: [^\n]*?(\d+) Hz", stderr_output)
+    return ([json.loads(block) for _, block in sorted(blocks, key=lambda block: int(block[0]))],
+            sample_rate.group(1) if sample_rate else None)
+
+
+def render_segments(input_file: str, intervals: List[tuple], outputs: List[dict], filters: str = "",
+                    normalize: bool = False, audio_segment=None) -> bool:
+    """
+    Renders intervals of a call to their own files in a single decode/encode pass: every interval is trimmed,
+    run through the user's filters and (two pass, linear) loudnorm in one filter graph and encoded once to each
+    of its formats, all intervals from one ffmpeg process.
 
-    This function uses the ffmpeg command-line tool to apply the given audio filters to the input file. The processed audio
-    is then saved to the output file. This can be used to adjust various audio properties such as volume, equalization, etc.
+    Normalizing measures every interval first. With the call's decoded audio at hand (and no user filters, which
+    only ffmpeg can apply) they're measured in process, converting only each interval's slice of the call,
+    otherwise by one more ffmpeg process.
 
     Args:
-        input_file (str): The path to the input audio file that needs to be processed.
-        output_file (str): The path where the processed audio file will be saved.
-        filters (str): The ffmpeg filter chain to apply to the audio.
+        input_file (str): The path to the call's audio.
+        intervals (List[tuple]): (start, end) in seconds per output, end None runs to the end of the call.
+        outputs (List[dict]): Paths each interval is written to by format (see ARTIFACT_FORMATS).
+        filters (str): The user's ffmpeg filter chain, empty for none.
+        normalize (bool): Normalize every interval to -16 LUFS.
+        audio_segment (AudioSegment): The call's decoded audio, None if it isn't at hand.
 
     Returns:
-        bool: True if the audio was successfully processed and saved, otherwise False.
+        bool: True if every interval was rendered, otherwise False.
     """
     try:
-        # Construct the command for applying filters using ffmpeg
-        command = [
-            "ffmpeg",
-            "-i", input_file,
-            "-af", filters,
-            "-y",
-            output_file
-        ]
-
-        # Execute the command to apply the filters and save the processed audio
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # A lone interval seeks to its start instead of decoding the call up to it
+        graph_intervals, input_options = intervals, []
+        if len(intervals) == 1 and intervals[0][0]:
+            start, end = intervals[0]
+            graph_intervals, input_options = [(0, None if end is None else end - start)], ["-ss", str(start)]
+
+        loudnorm = [None] * len(intervals)
+        rate_options = []
+        sample_rate = None
+        if normalize:
+            if audio_segment is not None and not filters:
+                sample_rate = audio_segment.frame_rate
+                measurements = []
+                for start, end in intervals:
+                    # pydub slices in milliseconds, only the interval is converted to samples
+                    end_ms = None if end is None else round(end * 1000)
+                    interval_audio = audio_segment[round((start or 0) * 1000):end_ms]
+                    measurements.append(measure_loudness(segment_samples(interval_audio), sample_rate))
+            else:
+                measurements, sample_rate = measure_loudness_ffmpeg(input_file, graph_intervals, filters,
+                                                                    input_options)
+            loudnorm = [f"loudnorm=I=-16:TP=-1.5:LRA=11:measured_I={params['input_i']}:"
+                        f"measured_LRA={params['input_lra']}:measured_TP={params['input_tp']}:"
+                        f"measured_thresh={params['input_thresh']}:offset={params['target_offset']}"
+                        for params in measurements]
+            # loudnorm runs at 192 kHz when it can't normalize linearly, keep the call's own rate like -af would
+            if sample_rate:
+                rate_options = ["-ar", str(sample_rate)]
+
+        chains = [segment_filter_chain(interval, filters, level)
+                  for interval, level in zip(graph_intervals, loudnorm)]
+        output_arguments = [[ARTIFACT_FORMATS[audio_format][1] +
+                             (rate_options if "-ar" not in ARTIFACT_FORMATS[audio_format][1] else []) + [path]
+                             for audio_format, path in artifacts.items()] for artifacts in outputs]
+        run_segment_graph(input_file, chains, output_arguments, input_options)
         return True
     except subprocess.CalledProcessError as e:
-        # Handle the specific exception raised for errors during the subprocess call
-        module_logger.error(f"An error occurred while applying filters: {e}")
+        module_logger.error(f"An error occurred while rendering audio segments: {e} "
+                            f"{e.stderr.decode('utf-8', 'replace').strip()}")
         return False
     except Exception as e:
-        # Catch any other exceptions and log the error
         traceback.print_exc()
-        module_logger.error(f"An unexpected ffmpeg filter error occurred: {e}")
+        module_logger.error(f"An unexpected error occurred while rendering audio segments: {e}")
         return False
 
 
@@ -293,7 +348,7 @@ def calculate_cut_length(call_length, interval):
         return round(interval[1] - interval[0], 2)  # Cut both from the beginning and end.
 
 
-def process_detection_audio(config_data, detection_data):
+def process_detection_audio(config_data, detection_data, audio_segment=None, on_ready=None):
     """
         Processes the detected audio segments based on the configurations and data provided.
 
@@ -306,12 +361,18 @@ def process_detection_audio(config_data, detection_data):
             config_data: Configuration data with details about how to process the audio.
             detection_data: Data containing details about the detected audio segments.
             call_data: Additional data related to the call.
+            audio_segment: The call's AudioSegment, segments are measured from it when normalized. None to
+                           measure them with ffmpeg.
+            on_ready: Called with each segment's data as soon as its audio is written.
 
         Returns:
             list: A list of dictionaries containing the final processed data.
-            In case of an error, it returns an empty list.
+            In case of an error, it returns the segments already handed to on_ready.
         """
 
+    final_data = []
+    # Indexes of the final_data entries handed to on_ready, their alerts are out whatever happens after
+    delivered = []
     try:
         input_audio_path = Path(detection_data["local_audio_path"])
 
@@ -331,7 +392,8 @@ def process_detection_audio(config_data, detection_data):
 
         matches_dict = detection_data['matches']
 
-        final_data = []
+        # Interval of each entry of final_data
+        segments = []
 
         for interval, tone_ids in zip(intervals, tone_ids_for_intervals):
 
@@ -376,36 +438,83 @@ def process_detection_audio(config_data, detection_data):
             else:
                 continue
 
-            with TemporaryDirectory() as temp_dir:
-                output_file_path = f'{input_base_dir}/{output_file_name}'
-                temp_dir_path = temp_dir
+            detection_json["local_audio_path"] = f'{input_base_dir}/{output_file_name}'
+            # Every format the alert actions deliver, rendered alongside the mp3 instead of each action transcoding
+            detection_json["artifacts"] = artifact_map(detection_json["local_audio_path"],
+                                                       artifact_formats(config_data, detection_json["matches"]))
+            segments.append(interval)
 
-                tmpfile_path = get_unique_file_path(temp_dir_path, "_segment.mp3")
-                extract_audio_segment(detection_data["local_audio_path"], interval[0], interval[1], tmpfile_path)
+            final_data.append(detection_json)
+
+        ffmpeg_filter = config_data["audio_processing"]["ffmpeg_filter"]
+        normalize = config_data["audio_processing"]["normalize"]
+        render_workers = config_data["audio_processing"].get("render_workers", 2)
+
+        if len(final_data) > 1 and render_workers > 1:
+            # Stacked dispatches, every interval renders on its own and is handed on as soon as it's written
+            # instead of after the slowest
+            pool = get_pool("render", render_workers)
+            futures = {pool.submit(render_segments, detection_data["local_audio_path"], [interval],
+                                   [segment["artifacts"]], ffmpeg_filter, normalize, audio_segment): index
+                       for index, (interval, segment) in enumerate(zip(segments, final_data))}
+            for future in as_completed(futures):
+                if future.result():
+                    if on_ready is not None:
+                        on_ready(final_data[futures[future]])
+                    delivered.append(futures[future])
+            return [final_data[index] for index in sorted(delivered)]
+
+        # Every interval of the call from one ffmpeg process
+        if final_data and not render_segments(detection_data["local_audio_path"], segments,
+                                              [segment["artifacts"] for segment in final_data],
+                                              ffmpeg_filter, normalize, audio_segment):
+            return []
+
+        for index, segment in enumerate(final_data):
+            if on_ready is not None:
+                on_ready(segment)
+            delivered.append(index)
+        return final_data
+    except Exception as e:
+        traceback.print_exc()
+        module_logger.error(f"An error occurred in process_detection_audio: {e}")
+        return [final_data[index] for index in sorted(delivered)]
 
-                last_processed_file = tmpfile_path
 
-                if config_data["audio_processing"]["ffmpeg_filter"] != "":
-                    output_file = get_unique_file_path(temp_dir_path, "_filtered.mp3")
-                    apply_filters(last_processed_file, output_file, config_data["audio_processing"]["ffmpeg_filter"])
-                    last_processed_file = output_file
+def encode_call_audio(working_audio_path, mp3_path=None):
+    """
+    Encodes a call's working audio (the PCM segments are rendered from) to mp3_path and removes it.
 
-                if config_data["audio_processing"]["normalize"]:
-                    segment_normalized_file = get_unique_file_path(temp_dir_path, "_segment_normalized.mp3")
-                    normalize_audio(last_processed_file, segment_normalized_file)
-                    last_processed_file = segment_normalized_file
+    Args:
+        working_audio_path (str): The path to the call's working audio.
+        mp3_path (str): Path the call's mp3 is written to, None to only remove the working audio.
 
-                copyfile(last_processed_file, output_file_path)
+    Returns:
+        bool: True if the mp3 was written or wasn't wanted, otherwise False.
+    """
+    try:
+        if mp3_path is not None:
+            subprocess.run(["ffmpeg", "-hide_banner", "-y", "-i", working_audio_path, mp3_path], check=True,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return True
+    except subprocess.CalledProcessError as e:
+        module_logger.error(f"An error occurred while encoding call audio: {e} "
+                            f"{e.stderr.decode('utf-8', 'replace').strip()}")
+        return False
+    finally:
+        if os.path.exists(working_audio_path):
+            os.remove(working_audio_path)
 
-            detection_json["local_audio_path"] = output_file_path
 
-            final_data.append(detection_json)
+def queue_call_audio(config_data, working_audio_path, mp3_path=None):
+    """
+    Runs encode_call_audio in the background, on at most audio_processing encode_workers threads.
 
-        return final_data
-    except Exception as e:
-        traceback.print_exc()
-        module_logger.error(f"An error occurred in process_detection_audio: {e}")
-        return []
+    Returns:
+        concurrent.futures.Future: Resolves to what encode_call_audio returns.
+    """
+    return get_pool("encode", config_data["audio_processing"].get("encode_workers", 1)).submit(
+        encode_call_audio, working_audio_path, mp3_path)
 
 
 def convert_mp3_opus(local_audio_path):
@@ -14,6 +14,37 @@ default_config = {
     },
     "tone_extraction": {
         "threshold_percent": 2,
+        "analysis_rate": 8000,
+        "engine": "stft",
+        "n_fft": 0,
+        "hop_ms": 100,
+        "stft": {
+            "interpolation": "bin"
+        },
+        "goertzel": {
+            "tonal_ratio": 0.05,
+            "window_ms": 32
+        },
+        "coarse_to_fine": {
+            "coarse_n_fft": 256,
+            "concentration": 0.35,
+            "fine_resolution": 1.0,
+            "fine_span_ms": 500,
+            "band": [250, 2700]
+        },
+        "pre_screen": {
+            "enabled": 0,
+            "block_ms": 32,
+            "min_tone_ms": 96,
+            "concentration": 0.35,
+            "similarity": 0.9,
+            "band": [280, 2600]
+        },
+        "head_scan": {
+            "enabled": 0,
+            "window": 10,
+            "talkgroups": {}
+        },
         "dtmf": {
             "enabled": 1
         },
@@ -31,7 +62,52 @@ default_config = {
         "check_for_split": 0,
         "maximum_split_length": 30,
         "maximum_split_interval": 45,
-        "minimum_audio_length": 4.5
+        "minimum_audio_length": 4.5,
+        "priority_talkgroups": []
+    },
+    "admission_control": {
+        "enabled": 0,
+        "max_concurrent": 4,
+        "max_decoded_bytes": 268435456,
+        "max_waiting": 32,
+        "max_wait": 10,
+        "retry_after": 5,
+        "compressed_kbps": 16
+    },
+    "split_buffer": {
+        "max_bytes": 67108864,
+        "ttl": 0,
+        "spill_path": "audio/pending"
+    },
+    "async_jobs": {
+        "enabled": 0,
+        "workers": 2,
+        "max_queue": 64,
+        "result_ttl": 3600,
+        "callback_url": "",
+        "callback_timeout": 10,
+        "retry_after": 5
+    },
+    "shared_state": {
+        "backend": "local",
+        "sqlite_path": "shared_state.db"
+    },
+    "extraction_executor": {
+        "enabled": 0,
+        "max_workers": 0
+    },
+    "spectrum_batching": {
+        "enabled": 0,
+        "max_batch": 32,
+        "max_wait_ms": 5,
+        "workers": -1,
+        "timeout_ms": 5000
+    },
+    "extraction_cache": {
+        "enabled": 0,
+        "max_entries": 512,
+        "ttl": 3600,
+        "sqlite_path": ""
     },
     "audio_processing": {
         "trim_tones": 0,
@@ -39,7 +115,9 @@ default_config = {
         "trim_pre_cut": 2.0,
         "trim_group_tone_gap": 6.5,
         "normalize": 0,
-        "ffmpeg_filter": ""
+        "ffmpeg_filter": "",
+        "render_workers": 2,
+        "encode_workers": 1
     },
     "transcribe_settings": {
         "enabled": 0,
@@ -4,6 +4,7 @@ import threading
 from threading import Thread
 import traceback
 
+from lib.audio_file_handler import get_artifact, remove_delivery_artifacts
 from lib.email_handler import generate_alert_email, EmailSender
 from lib.facebook_handler import generate_facebook_message, generate_facebook_comment, FacebookAPI
 from lib.remote_storage_handler import get_storage
@@ -18,6 +19,14 @@ threads = []
 
 
 def process_alert_actions(config_data, detection_data):
+    try:
+        run_alert_actions(config_data, detection_data)
+    finally:
+        # Formats other than the mp3 are only read by the actions, they go whether the actions ran or stopped early
+        remove_delivery_artifacts(detection_data)
+
+
+def run_alert_actions(config_data, detection_data):
     module_logger.info("Processing Tone Detection Alerts")
 
     triggered_detectors = detection_data["matches"]
@@ -30,10 +39,10 @@ def process_alert_actions(config_data, detection_data):
             storage = get_storage(config_data["remote_storage_settings"]["storage_type"],
                                   config_data["remote_storage_settings"])
 
-            remote_file_name = os.path.basename(detection_data['local_audio_path'])
+            remote_file_name = os.path.basename(get_artifact(detection_data, "mp3"))
 
             # Call the upload_file method to upload the audio file.
-            response = storage.upload_file(detection_data['local_audio_path'],
+            response = storage.upload_file(get_artifact(detection_data, "mp3"),
                                            config_data["remote_storage_settings"]["remote_path"],
                                            remote_file_name)
 
@@ -54,7 +63,7 @@ def process_alert_actions(config_data, detection_data):
     if config_data["transcribe_settings"].get("enabled", 0) == 1:
         module_logger.info("Transcribing Audio")
         try:
-            trans_result = get_transcription(config_data, detection_data['local_audio_path'])
+            trans_result = get_transcription(config_data, get_artifact(detection_data, "mp3"))
             if not trans_result:
                 detection_data["transcript"] = ""
             else:
@@ -160,7 +169,6 @@ def process_alert_actions(config_data, detection_data):
     else:
         module_logger.warning("Webhooks Disabled")
 
-
     # if config_data["twitter_settings"]["enabled"] == 1:
     #     module_logger.debug("Starting Twitter Post")
     #
@@ -0,0 +1,125 @@
+import heapq
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+module_logger = logging.getLogger('icad_tone_detection.expiring_set')
+
+
+def notify_expired(expiring_set, expired):
+    """Hands every (key, value) evicted from expiring_set to its on_expire, if it has one."""
+    if expiring_set.on_expire is None:
+        return
+    for key, value in expired:
+        try:
+            expiring_set.on_expire(key, value)
+        except Exception as e:
+            module_logger.error(f"Handling expired {expiring_set.name} {key} <<failed:>> {e}")
+
+
+class ExpiringSet:
+    """
+    Thread-safe set of keys that each drop out after their own number of seconds.
+
+    Entries live in a dict keyed by key, with a min-heap of (expires, key) beside it. Expired entries are evicted
+    lazily by whichever call comes next, popping only what has expired off the top of the heap, so there's no
+    polling thread and membership checks stay O(1). Every key carries a value that get(), pop() and values()
+    return, values() in the order the keys were (last) set.
+
+    When on_expire is given it's called with the key and value of every entry that expires, after the call that
+    evicted it has released the lock. expire() evicts on demand, for entries that have to be handled when they
+    expire rather than whenever the set is next used.
+
+    This is the local shared state backend, state only lives in this process. Backends shared between processes
+    (SQLiteExpiringSet, or a networked store) implement the same methods with the same atomicity, see
+    lib.shared_state_handler.
+    """
+
+    def __init__(self, name="entries", on_expire=None):
+        # What the entries are, for log messages
+        self.name = name
+        self.on_expire = on_expire
+        self._entries = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expires, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            # Keys added again after this heap entry was pushed have a later expiry of their own
+            if entry is not None and entry[0] == expires:
+                del self._entries[key]
+                expired.append((key, entry[1]))
+        if expired:
+            module_logger.info(f"{len(expired)} {self.name} expired")
+        return expired
+
+    @contextmanager
+    def _locked(self):
+        """Holds the lock with expired entries evicted, they go to on_expire once it's released."""
+        expired = []
+        self._lock.acquire()
+        try:
+            now = time.time()
+            expired = self._evict(now)
+            yield now
+        finally:
+            self._lock.release()
+            notify_expired(self, expired)
+
+    def check_and_set(self, key, ttl, value=None):
+        """
+        Adds key for ttl seconds unless it's already there, as one step.
+
+        Returns:
+            bool: True if key was added, False if it was already in the set.
+        """
+        with self._locked() as now:
+            if key in self._entries:
+                return False
+            self._set(key, now + ttl, value)
+            return True
+
+    def put(self, key, ttl, value=None):
+        """Sets key to value for ttl seconds (math.inf never expires), replacing what was there."""
+        with self._locked() as now:
+            self._entries.pop(key, None)
+            self._set(key, now + ttl, value)
+
+    def _set(self, key, expires, value):
+        self._entries[key] = (expires, value)
+        if expires != math.inf:
+            heapq.heappush(self._heap, (expires, key))
+
+    def get(self, key, default=None):
+        with self._locked():
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None else default
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value as one step, only one caller ever gets a given entry."""
+        with self._locked():
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry is not None else default
+
+    def expire(self):
+        """Evicts every entry that has expired by now."""
+        with self._locked():
+            pass
+
+    def __contains__(self, key):
+        with self._locked():
+            return key in self._entries
+
+    def __len__(self):
+        with self._locked():
+            return len(self._entries)
+
+    def values(self):
+        """Returns the value of every key still in the set, oldest first."""
+        with self._locked():
+            return [value for _, value in self._entries.values()]
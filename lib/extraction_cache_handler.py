@@ -0,0 +1,140 @@
+import copy
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+module_logger = logging.getLogger('icad_tone_detection.extraction_cache')
+
+
+class ExtractionCache:
+    """
+    LRU cache of tone extraction results keyed by audio content and extraction settings.
+
+    Entries live in memory up to max_entries, each for ttl seconds. With sqlite_path set, results are also
+    written to an on-disk SQLite tier (same size and TTL limits) that survives restarts and is shared by every
+    gunicorn worker on the box. Memory misses that hit on disk are promoted back into memory.
+    """
+
+    def __init__(self, max_entries=512, ttl=3600, sqlite_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path or None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.sqlite_path:
+            with self._get_connection() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS extraction_cache "
+                             "(cache_key TEXT PRIMARY KEY, result TEXT NOT NULL, duration REAL NOT NULL, "
+                             "expires REAL NOT NULL)")
+                conn.commit()
+
+    @contextmanager
+    def _get_connection(self):
+        conn = sqlite3.connect(self.sqlite_path, timeout=5)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(audio, extraction_settings):
+        """
+        Builds a cache key from audio content and the extraction settings that produced the result.
+
+        Args:
+            audio: Raw upload as a seekable binary stream (read in chunks, then rewound), or any buffer such as
+                bytes or a contiguous NumPy array of samples.
+            extraction_settings (dict): config_data["tone_extraction"]
+
+        Returns:
+            str: Hex digest.
+        """
+        digest = hashlib.sha256()
+        if hasattr(audio, "read"):
+            start = audio.tell()
+            for chunk in iter(lambda: audio.read(65536), b""):
+                digest.update(chunk)
+            audio.seek(start)
+        else:
+            digest.update(memoryview(audio).cast("B"))
+        digest.update(json.dumps(extraction_settings, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: ((quick_call, hi_low, long, dtmf), duration) or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, result, duration = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(result), duration
+                del self._entries[key]
+
+        if self.sqlite_path:
+            try:
+                with self._get_connection() as conn:
+                    row = conn.execute("SELECT result, duration, expires FROM extraction_cache "
+                                       "WHERE cache_key = ? AND expires > ?", (key, now)).fetchone()
+            except sqlite3.Error as e:
+                module_logger.error(f"Extraction cache lookup <<failed:>> {e}")
+                row = None
+
+            if row is not None:
+                result = tuple(json.loads(row[0]))
+                with self._lock:
+                    self._store(key, row[2], result, row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                return copy.deepcopy(result), row[1]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result, duration):
+        """Stores the (quick_call, hi_low, long, dtmf) result of extracting audio that is duration seconds long."""
+        expires = time.time() + self.ttl
+        result = tuple(copy.deepcopy(result))
+        with self._lock:
+            self._store(key, expires, result, duration)
+
+        if self.sqlite_path:
+            try:
+                with self._get_connection() as conn:
+                    conn.execute("INSERT OR REPLACE INTO extraction_cache (cache_key, result, duration, expires) "
+                                 "VALUES (?, ?, ?, ?)", (key, json.dumps(result), duration, expires))
+                    conn.execute("DELETE FROM extraction_cache WHERE expires <= ?", (time.time(),))
+                    conn.execute("DELETE FROM extraction_cache WHERE cache_key NOT IN "
+                                 "(SELECT cache_key FROM extraction_cache ORDER BY expires DESC LIMIT ?)",
+                                 (self.max_entries,))
+                    conn.commit()
+            except sqlite3.Error as e:
+                module_logger.error(f"Extraction cache store <<failed:>> {e}")
+
+    def _store(self, key, expires, result, duration):
+        self._entries[key] = (expires, result, duration)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0}
@@ -0,0 +1,136 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from lib.config_handler import default_config
+from lib.tone_extraction_handler import ToneExtraction
+
+module_logger = logging.getLogger('icad_tone_detection.extraction_executor')
+
+
+def warm_up():
+    """
+    Runs once in every worker process as it starts. Runs the STFT engine's framing and rfft over a second of silence
+    so the first real extraction in a fresh worker doesn't pay for imports and FFT plan setup.
+    """
+    ToneExtraction(default_config).detect_tones(np.zeros(8000, dtype=np.float32), 8000)
+    return os.getpid()
+
+
+def extract_from_shared_memory(config_data, memory_name, sample_count, sample_rate, extraction_options=None):
+    """
+    Worker side of ExtractionExecutor, runs ToneExtraction over samples the parent placed in shared memory.
+
+    Args:
+        config_data (dict): Configuration data.
+        memory_name (str): Name of the SharedMemory block holding the float32 samples.
+        sample_count (int): Number of samples in the block.
+        sample_rate (int): Sample rate of the samples.
+        extraction_options (dict): Extra ToneExtraction keyword arguments (talkgroup, known_frequencies, ...).
+
+    Returns:
+        tuple: ((quick_call, hi_low, long, dtmf) as returned by ToneExtraction.main(), its frame_frequencies)
+    """
+    memory = shared_memory.SharedMemory(name=memory_name)
+    samples = extraction = None
+    try:
+        samples = np.ndarray((sample_count,), dtype=np.float32, buffer=memory.buf)
+        extraction = ToneExtraction(config_data, samples=samples, sample_rate=sample_rate,
+                                    **(extraction_options or {}))
+        return extraction.main(), extraction.frame_frequencies
+    finally:
+        # Views into the block have to be gone before it can be closed
+        del samples, extraction
+        try:
+            memory.close()
+        except BufferError:
+            # The traceback of an exception on its way out still holds views from the frames it passed through,
+            # the block is closed once they're collected and the caller sees that exception rather than this one.
+            module_logger.debug(f"Shared memory {memory_name} still in use, closing it when released.")
+
+
+class ExtractionExecutor:
+    """
+    Runs tone extraction in a pool of worker processes so CPU bound extraction from concurrent uploads
+    scales with cores instead of contending for the GIL in one gunicorn worker.
+
+    Decoded samples are copied once into a shared memory block and the worker maps it, nothing large is pickled.
+    The pool is created on first use, so it is created inside each gunicorn worker rather than in the master.
+    """
+
+    def __init__(self, max_workers=0):
+        self.max_workers = max_workers or os.cpu_count()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self, reset=False):
+        with self._lock:
+            if reset and self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+            if self._pool is None:
+                module_logger.info(f"Starting extraction process pool with {self.max_workers} workers")
+                # spawn so children don't inherit the Flask app's threads and locks
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=warm_up)
+            return self._pool
+
+    def start(self):
+        """Starts every worker process now, instead of on the first uploads."""
+        pool = self._get_pool()
+        futures = [pool.submit(warm_up) for _ in range(self.max_workers)]
+        worker_pids = {future.result() for future in futures}
+        module_logger.info(f"Extraction process pool warmed up, {len(worker_pids)} workers ready")
+
+    def submit(self, config_data, samples, sample_rate, **extraction_options):
+        """
+        Queues an extraction.
+
+        Args:
+            config_data (dict): Configuration data.
+            samples (numpy.ndarray): Mono samples.
+            sample_rate (int): Sample rate of samples.
+            **extraction_options: Extra ToneExtraction keyword arguments (talkgroup, known_frequencies, ...).
+
+        Returns:
+            concurrent.futures.Future: Resolves to ((quick_call, hi_low, long, dtmf), per frame frequencies).
+        """
+        samples = np.ascontiguousarray(samples, dtype=np.float32)
+        memory = shared_memory.SharedMemory(create=True, size=max(samples.nbytes, 1))
+        np.ndarray(samples.shape, dtype=np.float32, buffer=memory.buf)[:] = samples
+
+        def release(_future):
+            memory.close()
+            memory.unlink()
+
+        try:
+            try:
+                future = self._get_pool().submit(extract_from_shared_memory, config_data, memory.name, len(samples),
+                                                 sample_rate, extraction_options)
+            except BrokenProcessPool:
+                module_logger.warning("Extraction process pool is broken, restarting it.")
+                future = self._get_pool(reset=True).submit(extract_from_shared_memory, config_data, memory.name,
+                                                           len(samples), sample_rate, extraction_options)
+        except Exception:
+            release(None)
+            raise
+
+        future.add_done_callback(release)
+        return future
+
+    def extract(self, config_data, samples, sample_rate, timeout=None, **extraction_options):
+        """Submits an extraction and waits for its result."""
+        return self.submit(config_data, samples, sample_rate, **extraction_options).result(timeout=timeout)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
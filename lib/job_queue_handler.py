@@ -0,0 +1,146 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+
+import numpy as np
+import requests
+
+module_logger = logging.getLogger('icad_tone_detection.job_queue')
+
+
+class JobQueue:
+    """
+    Runs uploads in the background so the recorder gets its answer straight away instead of waiting through
+    extraction, export and detection (and timing out and retrying under load).
+
+    submit() queues a job and returns its id, up to max_queue jobs wait at once. workers threads run the jobs,
+    priority jobs first and otherwise in the order they came, through handler, which returns (result, status code)
+    like the synchronous endpoint. The record of every job (status, times, result) is kept in jobs, an ExpiringSet
+    on the shared state backend, for result_ttl seconds so any worker can answer a status request for it. A job's
+    record is POSTed to its callback_url once it's done.
+
+    The threads are started on first use, so they are started inside each gunicorn worker rather than in the
+    master.
+    """
+
+    # Finished jobs the latency figures in stats() are taken over
+    latency_window = 1000
+
+    def __init__(self, handler, jobs, workers=2, max_queue=64, result_ttl=3600, callback_timeout=10):
+        self.handler = handler
+        self.jobs = jobs
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self.callback_timeout = callback_timeout
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._waits = deque(maxlen=self.latency_window)
+        self._run_times = deque(maxlen=self.latency_window)
+        self._latencies = deque(maxlen=self.latency_window)
+        self._queue = queue.PriorityQueue(maxsize=max_queue)
+        self._arrivals = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if not self._threads:
+                module_logger.info(f"Starting {self.workers} job workers")
+                for index in range(self.workers):
+                    thread = threading.Thread(target=self._run, name=f"job-worker-{index}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def submit(self, args, callback_url=None, priority=False):
+        """
+        Queues a job.
+
+        Args:
+            args (tuple): Arguments handler is called with.
+            callback_url (str): URL the job's record is POSTed to when it's done, None for no callback.
+            priority (bool): Run the job ahead of every job that isn't a priority one.
+
+        Returns:
+            str: Job id.
+
+        Raises:
+            queue.Full: max_queue jobs are already waiting.
+        """
+        if not self._threads:
+            self._start()
+        job_id = uuid.uuid4().hex
+        record = {"job_id": job_id, "status": "queued", "submitted": time.time(), "started": None, "finished": None,
+                  "status_code": None, "result": None}
+        self.jobs.put(job_id, self.result_ttl, record)
+        try:
+            self._queue.put_nowait((0 if priority else 1, next(self._arrivals), record, args, callback_url))
+        except queue.Full:
+            self.jobs.pop(job_id)
+            with self._lock:
+                self.rejected += 1
+            raise
+        return job_id
+
+    def get(self, job_id):
+        """Returns the record of a job, None once it's unknown or has expired."""
+        return self.jobs.get(job_id)
+
+    def _run(self):
+        while True:
+            _, _, record, args, callback_url = self._queue.get()
+            record["status"] = "running"
+            record["started"] = time.time()
+            self.jobs.put(record["job_id"], self.result_ttl, record)
+            with self._lock:
+                self.running += 1
+
+            try:
+                record["result"], record["status_code"] = self.handler(*args)
+                record["status"] = "done"
+            except Exception as e:
+                module_logger.error(f"Job {record['job_id']} <<failed:>> {e}")
+                record["result"], record["status_code"] = {"status": "error", "message": str(e)}, 500
+                record["status"] = "failed"
+            record["finished"] = time.time()
+            self.jobs.put(record["job_id"], self.result_ttl, record)
+
+            with self._lock:
+                self.running -= 1
+                if record["status"] == "done":
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self._waits.append(record["started"] - record["submitted"])
+                self._run_times.append(record["finished"] - record["started"])
+                self._latencies.append(record["finished"] - record["submitted"])
+
+            if callback_url:
+                self._callback(callback_url, record)
+
+    def _callback(self, callback_url, record):
+        try:
+            response = requests.post(callback_url, json=record, timeout=self.callback_timeout)
+            if response.status_code >= 400:
+                module_logger.error(f"Job {record['job_id']} callback failed with status code "
+                                    f"{response.status_code} {response.text}")
+        except requests.exceptions.RequestException as e:
+            module_logger.error(f"Job {record['job_id']} callback <<failed:>> {e}")
+
+    def stats(self):
+        with self._lock:
+            waits = np.array(self._waits) * 1000
+            run_times = np.array(self._run_times) * 1000
+            latencies = np.array(self._latencies) * 1000
+            stats = {"queued": self._queue.qsize(), "max_queue": self._queue.maxsize, "running": self.running,
+                     "completed": self.completed, "failed": self.failed, "rejected": self.rejected}
+        for name, values in (("queue_wait_ms", waits), ("run_time_ms", run_times), ("latency_ms", latencies)):
+            stats[name] = {"p50": round(float(np.percentile(values, 50)), 1),
+                           "p95": round(float(np.percentile(values, 95)), 1),
+                           "max": round(float(values.max()), 1)} if len(values) else None
+        return stats
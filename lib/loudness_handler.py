@@ -0,0 +1,122 @@
+import logging
+import math
+
+import numpy as np
+from scipy.signal import lfilter, resample_poly
+
+module_logger = logging.getLogger('icad_tone_detection.loudness')
+
+# ITU-R BS.1770 gating
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+# EBU Tech 3342 loudness range
+RANGE_RELATIVE_GATE = -20.0
+
+
+def segment_samples(audio_segment):
+    """
+    Returns the PCM of a pydub AudioSegment as float64 samples scaled to [-1, 1], shaped (samples, channels).
+    """
+    # pydub hands back signed samples at every width, 8 bit included
+    samples = np.array(audio_segment.get_array_of_samples(), dtype=np.float64)
+    samples /= 2 ** (audio_segment.sample_width * 8 - 1)
+    return samples.reshape(-1, audio_segment.channels)
+
+
+def k_weighting(sample_rate):
+    """
+    Computes the two biquads of the BS.1770 K-weighting filter (high shelf, then high pass) for sample_rate.
+
+    Returns:
+        list: (b, a) coefficients of each stage.
+    """
+    # High shelf modelling the head
+    k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    gain = 10 ** (3.999843853973347 / 20)
+    gain_band = gain ** 0.4996667741545416
+    q = 0.7071752369554196
+    a0 = 1 + k / q + k * k
+    shelf = ([(gain + gain_band * k / q + k * k) / a0, 2 * (k * k - gain) / a0,
+              (gain - gain_band * k / q + k * k) / a0],
+             [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+
+    # RLB high pass
+    k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = ([1.0, -2.0, 1.0], [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return [shelf, high_pass]
+
+
+def block_powers(weighted, sample_rate, block_seconds, step_seconds):
+    """
+    Mean square of K-weighted samples over blocks of block_seconds every step_seconds, summed over channels.
+    """
+    block = int(round(block_seconds * sample_rate))
+    step = int(round(step_seconds * sample_rate))
+    if len(weighted) < block:
+        return np.empty(0)
+
+    energy = np.concatenate((np.zeros(1), np.cumsum(np.sum(weighted * weighted, axis=1))))
+    starts = np.arange(0, len(weighted) - block + 1, step)
+    return (energy[starts + block] - energy[starts]) / block
+
+
+def power_to_lufs(power):
+    with np.errstate(divide='ignore'):
+        return -0.691 + 10 * np.log10(power)
+
+
+def measure_loudness(samples, sample_rate):
+    """
+    Measures samples the way ffmpeg's loudnorm filter does in its first pass, so the result can be handed
+    straight to loudnorm's linear (second pass) mode without ffmpeg decoding the audio to measure it.
+
+    Integrated loudness and its relative gate follow ITU-R BS.1770 (400 ms blocks, 75% overlap, gated at
+    -70 LUFS and 10 LU below the ungated level), loudness range follows EBU Tech 3342 (3 s blocks, gated at
+    -70 LUFS and 20 LU, 10th to 95th percentile) and true peak is the peak of the samples oversampled four times.
+
+    Args:
+        samples (numpy.ndarray): Samples scaled to [-1, 1], mono or shaped (samples, channels).
+        sample_rate (int): Sample rate of samples.
+
+    Returns:
+        dict: input_i, input_lra, input_tp, input_thresh and target_offset as loudnorm prints them, clamped to the
+              ranges loudnorm accepts them in.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+
+    weighted = samples
+    for b, a in k_weighting(sample_rate):
+        weighted = lfilter(b, a, weighted, axis=0)
+
+    # Integrated loudness over the blocks above both gates
+    powers = block_powers(weighted, sample_rate, 0.4, 0.1)
+    powers = powers[power_to_lufs(powers) > ABSOLUTE_GATE]
+    integrated = threshold = -70.0
+    if len(powers):
+        threshold = power_to_lufs(np.mean(powers)) + RELATIVE_GATE
+        gated = powers[power_to_lufs(powers) > threshold]
+        integrated = power_to_lufs(np.mean(gated)) if len(gated) else -70.0
+
+    # Loudness range over short term loudness
+    loudness_range = 0.0
+    powers = block_powers(weighted, sample_rate, 3.0, 0.1)
+    powers = powers[power_to_lufs(powers) > ABSOLUTE_GATE]
+    if len(powers):
+        short_term = power_to_lufs(powers)
+        short_term = short_term[short_term > power_to_lufs(np.mean(powers)) + RANGE_RELATIVE_GATE]
+        if len(short_term):
+            loudness_range = np.percentile(short_term, 95) - np.percentile(short_term, 10)
+
+    oversampled = resample_poly(samples, 4, 1, axis=0) if len(samples) else samples
+    peak = np.max(np.abs(oversampled)) if oversampled.size else 0.0
+    true_peak = 20 * math.log10(peak) if peak > 0 else -99.0
+
+    return {"input_i": f"{min(max(integrated, -99.0), 0.0):.2f}",
+            "input_tp": f"{min(max(true_peak, -99.0), 99.0):.2f}",
+            "input_lra": f"{min(max(loudness_range, 0.0), 99.0):.2f}",
+            "input_thresh": f"{min(max(threshold, -99.0), 0.0):.2f}",
+            "target_offset": "0.00"}
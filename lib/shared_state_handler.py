@@ -0,0 +1,147 @@
+import logging
+import pickle
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from lib.expiring_set_handler import ExpiringSet, notify_expired
+
+module_logger = logging.getLogger('icad_tone_detection.shared_state')
+
+
+class SQLiteExpiringSet:
+    """
+    ExpiringSet kept in a SQLite database in WAL mode, shared by every gunicorn worker on the box.
+
+    Each method is one transaction. check_and_set() and pop() take the write lock up front (BEGIN IMMEDIATE), so
+    when two workers race for the same key exactly one of them sets or takes it: a detector only alerts once
+    across workers, and a split call's first half is only stitched by one of them.
+
+    Any other store (Redis, a database server, ...) can back the shared state by implementing the same methods:
+    check_and_set(key, ttl, value), put(key, ttl, value), get(key), pop(key), values(), `in` and len(), with
+    check_and_set and pop atomic across every process using the store, and on_expire called in whichever process
+    evicted an entry, exactly once.
+
+    Values are pickled, the database must only be writable by this service.
+    """
+
+    def __init__(self, sqlite_path, name="entries", on_expire=None):
+        self.sqlite_path = sqlite_path
+        # Namespace of this set within the database, and what its entries are for log messages
+        self.name = name
+        self.on_expire = on_expire
+
+        conn = sqlite3.connect(self.sqlite_path, timeout=10, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+        finally:
+            conn.close()
+        with self._transaction(immediate=True) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS shared_state "
+                         "(name TEXT NOT NULL, key TEXT NOT NULL, value BLOB, expires REAL NOT NULL, "
+                         "PRIMARY KEY (name, key))")
+            conn.execute("CREATE INDEX IF NOT EXISTS shared_state_expires ON shared_state (name, expires)")
+
+    @contextmanager
+    def _transaction(self, immediate=False):
+        conn = sqlite3.connect(self.sqlite_path, timeout=10, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _evict(self, conn, now):
+        expired = []
+        if self.on_expire is not None:
+            rows = conn.execute("SELECT key, value FROM shared_state WHERE name = ? AND expires <= ?",
+                                (self.name, now)).fetchall()
+            expired = [(key, pickle.loads(value)) for key, value in rows]
+        removed = conn.execute("DELETE FROM shared_state WHERE name = ? AND expires <= ?", (self.name, now)).rowcount
+        if removed:
+            module_logger.info(f"{removed} {self.name} expired")
+        return expired
+
+    def check_and_set(self, key, ttl, value=None):
+        """
+        Adds key for ttl seconds unless it's already there, as one step.
+
+        Returns:
+            bool: True if key was added, False if it was already in the set.
+        """
+        now = time.time()
+        with self._transaction(immediate=True) as conn:
+            expired = self._evict(conn, now)
+            added = conn.execute("INSERT OR IGNORE INTO shared_state (name, key, value, expires) VALUES (?, ?, ?, ?)",
+                                 (self.name, str(key), pickle.dumps(value), now + ttl)).rowcount == 1
+        notify_expired(self, expired)
+        return added
+
+    def put(self, key, ttl, value=None):
+        """Sets key to value for ttl seconds (math.inf never expires), replacing what was there."""
+        now = time.time()
+        with self._transaction(immediate=True) as conn:
+            expired = self._evict(conn, now)
+            # Replacing deletes the old row, the key moves to the end of values() like a fresh one
+            conn.execute("INSERT OR REPLACE INTO shared_state (name, key, value, expires) VALUES (?, ?, ?, ?)",
+                         (self.name, str(key), pickle.dumps(value), now + ttl))
+        notify_expired(self, expired)
+
+    def get(self, key, default=None):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM shared_state WHERE name = ? AND key = ? AND expires > ?",
+                               (self.name, str(key), time.time())).fetchone()
+        return pickle.loads(row[0]) if row is not None else default
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value as one step, only one caller in any process ever gets a given entry."""
+        now = time.time()
+        with self._transaction(immediate=True) as conn:
+            expired = self._evict(conn, now)
+            row = conn.execute("SELECT value FROM shared_state WHERE name = ? AND key = ?",
+                               (self.name, str(key))).fetchone()
+            conn.execute("DELETE FROM shared_state WHERE name = ? AND key = ?", (self.name, str(key)))
+        notify_expired(self, expired)
+        return pickle.loads(row[0]) if row is not None else default
+
+    def expire(self):
+        """Evicts every entry that has expired by now."""
+        with self._transaction(immediate=True) as conn:
+            expired = self._evict(conn, time.time())
+        notify_expired(self, expired)
+
+    def __contains__(self, key):
+        with self._transaction() as conn:
+            return conn.execute("SELECT 1 FROM shared_state WHERE name = ? AND key = ? AND expires > ?",
+                                (self.name, str(key), time.time())).fetchone() is not None
+
+    def __len__(self):
+        with self._transaction() as conn:
+            return conn.execute("SELECT COUNT(*) FROM shared_state WHERE name = ? AND expires > ?",
+                                (self.name, time.time())).fetchone()[0]
+
+    def values(self):
+        """Returns the value of every key still in the set, oldest first."""
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT value FROM shared_state WHERE name = ? AND expires > ? ORDER BY rowid",
+                                (self.name, time.time())).fetchall()
+        return [pickle.loads(row[0]) for row in rows]
+
+
+def create_expiring_set(config_data, name, on_expire=None):
+    """
+    Returns the ExpiringSet for name on the configured shared state backend, "local" (this process only, the
+    default) or "sqlite" (every worker on the box), calling on_expire with each entry that expires.
+    """
+    settings = config_data.get("shared_state", {})
+    backend = settings.get("backend", "local")
+    if backend == "sqlite":
+        return SQLiteExpiringSet(settings.get("sqlite_path", "shared_state.db"), name, on_expire)
+    if backend != "local":
+        module_logger.warning(f"Unknown shared state backend {backend}, keeping {name} in this process.")
+    return ExpiringSet(name, on_expire)
@@ -0,0 +1,125 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+
+from lib.tone_extraction_handler import frame_peaks
+
+module_logger = logging.getLogger('icad_tone_detection.spectrum_batch')
+
+
+class SpectrumBatcher:
+    """
+    Runs the per frame FFTs of concurrent tone extractions together.
+
+    During an incident dozens of uploads arrive at once, and each extraction transforming its own frames pays
+    the Python and FFT planning overhead on its own. Extractions hand their framed audio to the batcher instead.
+    A single thread collects whatever arrives within max_wait_ms (up to max_batch extractions), stacks the
+    frames into one matrix, runs frame_peaks over it with scipy.fft workers and hands every extraction back the
+    peaks of its own frames. A lone upload waits at most max_wait_ms longer than it would have, and an extraction
+    whose batch hasn't come back within timeout_ms transforms its frames itself.
+
+    The thread is started on first use, so it is started inside each gunicorn worker rather than in the master.
+    """
+
+    # Rows transformed per rfft call, caps the spectrum held at once (~12 MB at a 750 point FFT)
+    block_frames = 4096
+
+    def __init__(self, max_batch=32, max_wait_ms=5, workers=-1, timeout_ms=5000):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.timeout = timeout_ms / 1000
+        self.workers = workers
+        self.batches = 0
+        self.requests = 0
+        self.frames = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                module_logger.info(f"Starting spectrum batcher, up to {self.max_batch} extractions per batch")
+                self._thread = threading.Thread(target=self._run, name="spectrum-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, frames, window, interpolation="bin"):
+        """
+        Queues the frames of one extraction.
+
+        Args:
+            frames (numpy.ndarray): Frames as rows (a view is fine, it is copied into the batch).
+            window (numpy.ndarray): Window applied to every frame before the FFT.
+            interpolation (str): Peak interpolation, see frame_peaks.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the peak position of every frame in fractional bins.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+        future = Future()
+        self._queue.put((frames, window, interpolation, future))
+        return future
+
+    def peaks(self, frames, window, interpolation="bin"):
+        """Submits the frames of one extraction and waits for their peaks, up to timeout before finding them itself."""
+        try:
+            return self.submit(frames, window, interpolation).result(timeout=self.timeout)
+        except TimeoutError:
+            module_logger.warning(f"Batched spectrum didn't return within {self.timeout}s, transforming directly.")
+            return frame_peaks(frames, window, interpolation, block_frames=self.block_frames)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                # Only frames of the same length and interpolation can share a transform
+                groups = {}
+                for item in batch:
+                    groups.setdefault((item[0].shape[1], item[2]), []).append(item)
+                for items in groups.values():
+                    self._transform(items)
+
+                with self._lock:
+                    self.batches += 1
+                    self.requests += len(batch)
+                    self.frames += sum(len(item[0]) for item in batch)
+            except Exception as e:
+                # Whatever went wrong, the thread keeps serving and nobody waits on a future that won't resolve
+                module_logger.error(f"Spectrum batch <<failed:>> {e}")
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _transform(self, items):
+        try:
+            stacked = np.concatenate([frames for frames, _, _, _ in items])
+            positions = frame_peaks(stacked, items[0][1], items[0][2], self.workers, self.block_frames)
+        except Exception as e:
+            module_logger.error(f"Batched spectrum <<failed:>> {e}")
+            for _, _, _, future in items:
+                future.set_exception(e)
+            return
+
+        offsets = np.cumsum([len(frames) for frames, _, _, _ in items])[:-1]
+        for (_, _, _, future), position in zip(items, np.split(positions, offsets)):
+            future.set_result(position)
+
+    def stats(self):
+        with self._lock:
+            return {"batches": self.batches, "requests": self.requests, "frames": self.frames,
+                    "mean_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0}
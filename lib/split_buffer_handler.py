@@ -0,0 +1,156 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+from pydub import AudioSegment
+
+from lib.expiring_set_handler import ExpiringSet
+from lib.shared_state_handler import create_expiring_set
+
+module_logger = logging.getLogger('icad_tone_detection.split_buffer')
+
+
+class SplitCallBuffer:
+    """
+    First halves of split calls waiting for the rest of the call, by talkgroup.
+
+    Each entry holds the call's analysis samples and its AudioSegment until the next upload on the talkgroup takes
+    it, or for ttl seconds (maximum_split_interval unless set). A timer evicts it once that's up, and expired
+    entries are handed to on_expire(talkgroup, entry) on their own thread, so the call still goes through detection
+    instead of sitting in memory forever.
+
+    Entries kept in memory are capped at max_bytes of audio in total. Past that the samples and audio of new
+    entries are spilled to raw PCM files under spill_path and read back when the entry is taken. On a shared state
+    backend every entry is spilled, the audio stays out of the database and any worker on the box can read it.
+    Spill files left behind by a process that stopped before their entry was taken are removed on start.
+    """
+
+    def __init__(self, config_data, on_expire, name="split calls"):
+        settings = config_data.get("split_buffer", {})
+        self.max_bytes = settings.get("max_bytes", 67108864)
+        self.ttl = settings.get("ttl", 0) or config_data["upload_processing"].get("maximum_split_interval", 45)
+        self.spill_path = settings.get("spill_path", "audio/pending")
+        self.on_expire = on_expire
+        self.memory_bytes = 0
+        self.stitched = 0
+        self.flushed = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+        self._state = create_expiring_set(config_data, name, self._expired)
+        self._local = isinstance(self._state, ExpiringSet)
+
+        if not os.path.exists(self.spill_path):
+            os.makedirs(self.spill_path)
+        self._sweep()
+
+    def put(self, talkgroup, entry):
+        """
+        Parks the first half of a split call.
+
+        Args:
+            talkgroup (str): Talkgroup the rest of the call will arrive on.
+            entry (dict): Call data, with the call's samples (float32 array) under "samples" and its AudioSegment
+                under "audio".
+        """
+        size = entry["samples"].nbytes + len(entry["audio"].raw_data)
+        with self._lock:
+            spill = not self._local or self.memory_bytes + size > self.max_bytes
+            if not spill:
+                self.memory_bytes += size
+
+        if spill:
+            entry = self._spill(entry)
+        else:
+            entry = dict(entry, bytes=size)
+        # Another upload on the talkgroup may have parked a call since this one took the last, it won't be
+        # stitched now so it goes through detection as if it had expired
+        previous = self._state.pop(talkgroup)
+        if previous is not None:
+            self._expired(talkgroup, previous)
+        self._state.put(talkgroup, self.ttl, entry)
+
+        # Margin so the wall clock has passed the entry's expiry when the timer fires
+        timer = threading.Timer(self.ttl + 1, self._state.expire)
+        timer.daemon = True
+        timer.start()
+
+    def take(self, talkgroup):
+        """Removes the pending first half for talkgroup and returns it, None if there isn't one."""
+        entry = self._state.pop(talkgroup)
+        if entry is None:
+            return None
+        with self._lock:
+            self.stitched += 1
+        return self._load(entry)
+
+    def flush(self, talkgroup, entry):
+        """Hands an entry from take() that the rest of the call didn't follow to on_expire, on its own thread."""
+        with self._lock:
+            self.flushed += 1
+        threading.Thread(target=self.on_expire, args=(talkgroup, entry), daemon=True).start()
+
+    def _expired(self, talkgroup, entry):
+        entry = self._load(entry)
+        if entry is not None:
+            self.flush(talkgroup, entry)
+
+    def _sweep(self):
+        # Workers on the box share spill_path, only files twice the ttl old are certain to have no entry left
+        cutoff = time.time() - 2 * self.ttl
+        removed = 0
+        for name in os.listdir(self.spill_path):
+            path = os.path.join(self.spill_path, name)
+            if not name.endswith((".f32", ".pcm")):
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError as e:
+                module_logger.warning(f"Removing orphaned split call spill file {path} <<failed:>> {e}")
+        if removed:
+            module_logger.info(f"Removed {removed} orphaned split call spill files from {self.spill_path}")
+
+    def _spill(self, entry):
+        path = os.path.join(self.spill_path, uuid.uuid4().hex)
+        audio = entry["audio"]
+        entry["samples"].astype(np.float32, copy=False).tofile(f"{path}.f32")
+        with open(f"{path}.pcm", 'wb') as f:
+            f.write(audio.raw_data)
+
+        with self._lock:
+            self.spilled += 1
+        module_logger.debug(f"Spilled split call audio to {path}")
+        return dict(entry, samples=None, audio=None, spill_path=path,
+                    audio_format={"sample_width": audio.sample_width, "frame_rate": audio.frame_rate,
+                                  "channels": audio.channels})
+
+    def _load(self, entry):
+        path = entry.get("spill_path")
+        if path is None:
+            with self._lock:
+                self.memory_bytes -= entry["bytes"]
+            return entry
+
+        try:
+            samples = np.fromfile(f"{path}.f32", dtype=np.float32)
+            with open(f"{path}.pcm", 'rb') as f:
+                audio = AudioSegment(data=f.read(), **entry["audio_format"])
+        except OSError as e:
+            module_logger.error(f"Reading spilled split call audio <<failed:>> {e}")
+            return None
+        finally:
+            for extension in ("f32", "pcm"):
+                if os.path.exists(f"{path}.{extension}"):
+                    os.remove(f"{path}.{extension}")
+        return dict(entry, samples=samples, audio=audio, spill_path=None)
+
+    def stats(self):
+        # len() can evict, which takes the lock itself
+        pending = len(self._state)
+        with self._lock:
+            return {"pending": pending, "memory_bytes": self.memory_bytes, "spilled": self.spilled,
+                    "stitched": self.stitched, "flushed": self.flushed}
@@ -4,7 +4,7 @@ import logging
 
 import requests
 
-from lib.audio_file_handler import convert_mp3_opus
+from lib.audio_file_handler import convert_mp3_opus, get_artifact
 
 module_logger = logging.getLogger('icad_tone_detection.telegram')
 
@@ -44,15 +44,19 @@ class TelegramAPI:
         return self._send_request('sendMessage', payload)
 
     def post_audio(self, detection_data, test_mode=True):
-        audio_path = detection_data.get("local_audio_path", None)
-        if not os.path.exists(audio_path):
-            module_logger.error(f"Audio file does not exist: {audio_path}")
-            return False
+        # Rendered with the segment's mp3, only converted here for segments that weren't
+        opus_file = get_artifact(detection_data, "opus")
+        converted = opus_file is None or not os.path.exists(opus_file)
+        if converted:
+            audio_path = get_artifact(detection_data, "mp3")
+            if audio_path is None or not os.path.exists(audio_path):
+                module_logger.error(f"Audio file does not exist: {audio_path}")
+                return False
 
-        opus_file = self._convert_to_opus(audio_path)
-        if not opus_file:
-            module_logger.error("Could not post audio to Telegram: no OGG file converted.")
-            return False
+            opus_file = self._convert_to_opus(audio_path)
+            if not opus_file:
+                module_logger.error("Could not post audio to Telegram: no OGG file converted.")
+                return False
 
         try:
             test_text = f'TEST TEST TEST TEST TEST'
@@ -75,7 +79,7 @@ class TelegramAPI:
             module_logger.error(f"Failed to open or read the audio file: {e}")
             return False
         finally:
-            if os.path.exists(opus_file):
+            if converted and os.path.exists(opus_file):
                 os.remove(opus_file)
 
         return result
@@ -2,92 +2,143 @@ import logging
 import threading
 import time
 
+import numpy as np
+
 from lib.audio_file_handler import process_detection_audio
 from lib.detection_action_handler import process_alert_actions
 
 module_logger = logging.getLogger('icad_tone_detection.tone_detection')
 
 
+class DetectorIndex:
+    """
+    Tone ranges of every detector in NumPy arrays, built once whenever the detectors are (re)loaded.
+
+    A ranges are kept sorted by their low end, so the detectors whose A range holds a tone are found with a
+    binary search over the few ranges starting within the widest range of it, then filtered on their B range.
+    Matching a Quick Call pair costs about the same with ten detectors or ten thousand.
+    """
+
+    def __init__(self, detector_data):
+        self.names = list(detector_data)
+        self.configs = [detector_data[name] for name in self.names]
+
+        def tone_range(key):
+            tones = np.array([detector_config.get(key, 0) for detector_config in self.configs], dtype=np.float64)
+            tolerances = np.array([detector_config["tone_tolerance"] / 100.0 * detector_config.get(key, 0)
+                                   for detector_config in self.configs], dtype=np.float64)
+            return tones, tones - tolerances, tones + tolerances
+
+        _, self.a_low, self.a_high = tone_range("a_tone")
+        _, self.b_low, self.b_high = tone_range("b_tone")
+        c_tones, self.c_low, self.c_high = tone_range("c_tone")
+        d_tones, self.d_low, self.d_high = tone_range("d_tone")
+        # Detectors that need a second C/D pair right after their A/B pair
+        self.sequential = (c_tones > 0) & (d_tones > 0)
+
+        self.a_order = np.argsort(self.a_low, kind="stable")
+        self.a_sorted_low = self.a_low[self.a_order]
+        self.a_max_width = float(np.max(self.a_high - self.a_low)) if self.names else 0.0
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, tone_a, tone_b):
+        """
+        Returns:
+            numpy.ndarray: Positions of the detectors whose A and B ranges hold tone_a and tone_b, in detector order.
+        """
+        # Only ranges starting at most the widest range below tone_a can reach it (the margin absorbs rounding)
+        first = np.searchsorted(self.a_sorted_low, tone_a - self.a_max_width - 1e-6, 'left')
+        last = np.searchsorted(self.a_sorted_low, tone_a, 'right')
+        positions = self.a_order[first:last]
+        positions = positions[(self.a_high[positions] >= tone_a) & (self.b_low[positions] <= tone_b) &
+                              (tone_b <= self.b_high[positions])]
+        return np.sort(positions)
+
+    def matches_cd(self, position, tone_c, tone_d):
+        return bool(self.c_low[position] <= tone_c <= self.c_high[position] and
+                    self.d_low[position] <= tone_d <= self.d_high[position])
+
+
 class ToneDetection:
     """Matches tones that were extracted to a set detector"""
 
-    def __init__(self, config_data, detector_data, qc_detector_list, detection_data):
+    def __init__(self, config_data, detector_data, ignored_detectors, detection_data, detector_index=None,
+                 audio_segment=None):
         self.config_data = config_data
         self.detector_data = detector_data
-        self.qc_detector_list = qc_detector_list
+        # ExpiringSet of the detector ids that matched recently and are ignored for their ignore_time
+        self.ignored_detectors = ignored_detectors
         self.detection_data = detection_data
+        # Built by load_detectors, only built here for callers that don't keep one
+        self.detector_index = detector_index if detector_index is not None else DetectorIndex(detector_data)
+        # The call's AudioSegment, loudness is measured from it when matched segments are normalized
+        self.audio_segment = audio_segment
+
+    def start_alerts(self, segment_data):
+        threading.Thread(target=process_alert_actions, args=(self.config_data, segment_data)).start()
 
     def detect_quick_call(self):
         matches_found = []
         match_list = [(tone["exact"][0], tone["exact"][1], tone["tone_id"]) for tone in
                       self.detection_data["quick_call"]]
-        excluded_id_list = [t["detector_id"] for t in self.qc_detector_list]
-
-        for detector in self.detector_data:
-            detector_config = self.detector_data[detector]
-            tolerance_a = detector_config["tone_tolerance"] / 100.0 * detector_config.get("a_tone", 0)
-            tolerance_b = detector_config["tone_tolerance"] / 100.0 * detector_config.get("b_tone", 0)
-            tolerance_c = detector_config["tone_tolerance"] / 100.0 * detector_config.get("c_tone", 0)
-            tolerance_d = detector_config["tone_tolerance"] / 100.0 * detector_config.get("d_tone", 0)
-            detector_ranges = [
-                (detector_config["a_tone"] - tolerance_a, detector_config["a_tone"] + tolerance_a),
-                (detector_config["b_tone"] - tolerance_b, detector_config["b_tone"] + tolerance_b),
-                (detector_config.get("c_tone", 0) - tolerance_c, detector_config.get("c_tone", 0) + tolerance_c),
-                (detector_config.get("d_tone", 0) - tolerance_d, detector_config.get("d_tone", 0) + tolerance_d)
-            ]
-
-            for i, tone in enumerate(match_list):
-                match_a = detector_ranges[0][0] <= tone[0] <= detector_ranges[0][1]
-                match_b = detector_ranges[1][0] <= tone[1] <= detector_ranges[1][1]
-                if match_a and match_b:
-                    valid_match = True
-                    tones_matched = f'{tone[0]}, {tone[1]}'
-                    tone_id = f"{tone[2]}"
-
-                    if detector_config.get("c_tone", 0) > 0 and detector_config.get("d_tone", 0) > 0:
-                        if i + 1 < len(match_list):
-                            next_tone = match_list[i + 1]
-                            match_c = detector_ranges[2][0] <= next_tone[0] <= detector_ranges[2][1]
-                            match_d = detector_ranges[3][0] <= next_tone[1] <= detector_ranges[3][1]
-                            if match_c and match_d:
-                                # If C and D tones also match, include them in the tones_matched
-                                tones_matched = f', {next_tone[0]}, {next_tone[1]}'
-                                tone_id += f', {next_tone[2]}'
-                            else:
-                                # If C and D tones don't match, this isn't a valid match
-                                valid_match = False
-                        else:
-                            valid_match = False
-
-                    if valid_match:
-                        module_logger.info(f"Match found for {detector}")
-
-                        match_data = {"tone_id": tone_id, "detector_name": detector,
-                                      "tones_matched": tones_matched,
-                                      "detector_config": detector_config
-                                      }
-
-                        if detector_config["detector_id"] in excluded_id_list:
-                            continue
-                        else:
-                            matches_found.append(match_data)
-                            excluded_id_list.append(detector_config["detector_id"])
-
-                            self.qc_detector_list.append({"last_detected": time.time(),
-                                                          "ignore_seconds": detector_config["ignore_time"],
-                                                          "detector_id": detector_config["detector_id"]})
+        matched_ids = set()
+        index = self.detector_index
+
+        # Every (detector, tone pair) whose A and B ranges match, taken detector by detector as they're configured
+        candidates = sorted((int(position), i) for i, tone in enumerate(match_list)
+                            for position in index.candidates(tone[0], tone[1]))
+
+        for position, i in candidates:
+            detector = index.names[position]
+            detector_config = index.configs[position]
+            tone = match_list[i]
+            valid_match = True
+            tones_matched = f'{tone[0]}, {tone[1]}'
+            tone_id = f"{tone[2]}"
+
+            if index.sequential[position]:
+                if i + 1 < len(match_list):
+                    next_tone = match_list[i + 1]
+                    if index.matches_cd(position, next_tone[0], next_tone[1]):
+                        # If C and D tones also match, include them in the tones_matched
+                        tones_matched = f', {next_tone[0]}, {next_tone[1]}'
+                        tone_id += f', {next_tone[2]}'
+                    else:
+                        # If C and D tones don't match, this isn't a valid match
+                        valid_match = False
+                else:
+                    valid_match = False
+
+            if valid_match:
+                module_logger.info(f"Match found for {detector}")
+
+                match_data = {"tone_id": tone_id, "detector_name": detector,
+                              "tones_matched": tones_matched,
+                              "detector_config": detector_config
+                              }
+
+                detector_id = detector_config["detector_id"]
+                if detector_id in matched_ids or not self.ignored_detectors.check_and_set(
+                        detector_id, detector_config["ignore_time"],
+                        {"last_detected": time.time(), "ignore_seconds": detector_config["ignore_time"],
+                         "detector_id": detector_id}):
+                    continue
+                else:
+                    matches_found.append(match_data)
+                    matched_ids.add(detector_id)
 
         self.detection_data["matches"] = matches_found
-        self.detection_data["all_triggered_detectors"] = self.qc_detector_list
+        triggered_detectors = self.ignored_detectors.values()
+        self.detection_data["all_triggered_detectors"] = triggered_detectors
 
         if len(matches_found) >= 1:
-            detection_data_processed = process_detection_audio(self.config_data, self.detection_data)
-            self.detection_data = detection_data_processed
-            for dd in self.detection_data:
-                threading.Thread(target=process_alert_actions, args=(
-                    self.config_data, dd)).start()
+            # Alerts for each segment start as soon as its audio is ready
+            self.detection_data = process_detection_audio(self.config_data, self.detection_data, self.audio_segment,
+                                                          on_ready=self.start_alerts)
         else:
             module_logger.warning(f"No matches for {match_list} found in detectors.")
 
-        module_logger.debug(f'Current detector List: {self.qc_detector_list}')
-        return self.qc_detector_list, self.detection_data
+        module_logger.debug(f'Current detector List: {triggered_detectors}')
+        return self.ignored_detectors, self.detection_data
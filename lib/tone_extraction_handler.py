@@ -1,15 +1,150 @@
 import logging
+import threading
+from math import ceil, gcd
 
 import numpy as np
-from scipy.signal import stft
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import next_fast_len, rfft, rfftfreq
+from scipy.signal import ZoomFFT, get_window, resample_poly
 
 module_logger = logging.getLogger('icad_tone_detection.tone_extraction')
 
+# Goertzel filter bank bases keyed by (rate, window length, threshold_percent), built once per worker.
+goertzel_basis_cache = {}
+# Set once the fallback from the goertzel engine to the stft engine has been logged
+goertzel_fallback_logged = False
+
+# Hann windows of frame_peaks keyed by length, and the per thread scratch matrices it reuses between calls.
+hann_windows = {}
+spectral_buffers = threading.local()
+
+# Hann windowed DFT rows of every bin keyed by FFT length, for evaluating single bins of the phase interpolation.
+dft_bases = {}
+
+# Baseband zoom FFTs and windows of the coarse to fine engine keyed by (rate, length, points, resolution).
+zoom_transform_cache = {}
+
+# One row per run of matching frames: first frame index, frame count, frequency of the first frame and its start time.
+tone_run_dtype = np.dtype([("start", np.int64), ("length", np.int64), ("frequency", np.float64), ("time", np.float64)])
+
+# Frequency resolution every analysis rate is held to, a 2048 point FFT at 22050 Hz (~10.8 Hz per bin).
+reference_rate = 22050
+reference_n_fft = 2048
+
+# Lowest analysis rate that keeps the top QCII tone (2573.2 Hz) and the threshold around it clear of the anti-aliasing
+# filter's roll-off below Nyquist, and the analysis rates below it that have already been warned about.
+minimum_analysis_rate = 6000
+warned_analysis_rates = set()
+
+
+def analysis_rate(config_data):
+    """
+    Configured tone_extraction analysis_rate as a whole number of Hz, raised to minimum_analysis_rate when it's lower.
+    Below that the upper Quick Call tones are above Nyquist and detection would quietly find nothing.
+    """
+    rate = int(round(config_data["tone_extraction"].get("analysis_rate", 8000)))
+    if rate >= minimum_analysis_rate:
+        return rate
+    if rate not in warned_analysis_rates:
+        warned_analysis_rates.add(rate)
+        module_logger.warning(f"analysis_rate {rate} puts the upper Quick Call tones above Nyquist, analysing at "
+                              f"{minimum_analysis_rate} instead.")
+    return minimum_analysis_rate
+
+
+def resample_audio(samples, from_rate, to_rate):
+    """Resamples mono float samples with a polyphase anti-aliasing filter."""
+    if from_rate == to_rate:
+        return samples
+    divisor = gcd(int(from_rate), int(to_rate))
+    return resample_poly(samples, int(to_rate) // divisor, int(from_rate) // divisor).astype(np.float32, copy=False)
+
+
+def parabolic_offset(left, centre, right):
+    """
+    Offset of a spectral peak from its bin, in bins, from the log magnitudes (or log powers) of the bin and its
+    neighbours.
+
+    A parabola through the peak bin and its neighbours on a log scale fits the main lobe of a Hann window
+    closely, so a tone between two bins is placed to within a small fraction of a bin.
+    """
+    curvature = left - 2 * centre + right
+    offset = 0.5 * (left - right) / np.where(curvature < 0, curvature, -np.inf)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def hann_window(n_fft):
+    # float32 Hann window, built once per length and shared read-only
+    if n_fft not in hann_windows:
+        window = get_window('hann', n_fft).astype(np.float32)
+        window.flags.writeable = False
+        hann_windows[n_fft] = window
+    return hann_windows[n_fft]
+
+
+def _spectral_buffer(name, rows, columns, dtype=np.float32):
+    # Scratch matrix of this thread reused across calls, grown when a larger one is needed
+    buffers = spectral_buffers.__dict__
+    buffer = buffers.get((name, columns))
+    if buffer is None or len(buffer) < rows:
+        buffer = buffers[(name, columns)] = np.empty((rows, columns), dtype=dtype)
+    return buffer[:rows]
+
+
+def frame_peaks(frames, window, interpolation="bin", workers=None, block_frames=1024):
+    """
+    Where the strongest bin of every frame's spectrum lies.
+
+    Runs in float32 throughout, block_frames frames at a time. Each block is windowed into a reused buffer,
+    transformed, and its spectrum squared in place into a reused power matrix. The argmax of the power is the
+    argmax of any level scale, so there's no dB conversion, only the three bins around each peak go through a
+    log for the interpolation. Memory stays at a few MB whatever the length of the call.
+
+    Args:
+        frames (numpy.ndarray): Frames as rows (a strided view is fine, it is never copied whole).
+        window (numpy.ndarray): Window applied to every frame.
+        interpolation (str): "bin" keeps the strongest bin, "parabolic" places the peak between bins.
+        workers (int): scipy.fft workers.
+        block_frames (int): Frames transformed per rfft call.
+
+    Returns:
+        numpy.ndarray: Peak position of every frame in fractional bins.
+    """
+    frame_total, n_fft = frames.shape
+    bins = n_fft // 2 + 1
+    positions = np.empty(frame_total, dtype=np.float64)
+
+    for start in range(0, frame_total, block_frames):
+        block = frames[start:start + block_frames]
+        windowed = _spectral_buffer("windowed", len(block), n_fft)
+        np.multiply(block, window, out=windowed)
+        spectrum = rfft(windowed, axis=1, workers=workers, overwrite_x=True)
+
+        # |X|^2 as re^2 + im^2, squared in place in the spectrum's own memory
+        parts = spectrum.view(np.float32).reshape(len(block), bins, 2)
+        np.square(parts, out=parts)
+        power = _spectral_buffer("power", len(block), bins)
+        np.add(parts[:, :, 0], parts[:, :, 1], out=power)
+
+        peak = np.argmax(power, axis=1)
+        position = positions[start:start + len(block)]
+        position[:] = peak
+        if interpolation == "parabolic":
+            # Band edges and flat (silent) frames stay on their bin
+            inner = np.flatnonzero((peak > 0) & (peak < bins - 1))
+            rows, centre = inner, peak[inner]
+            levels = np.log(np.maximum(power[rows[:, None], centre[:, None] + np.arange(-1, 2)], 1e-30),
+                            dtype=np.float64)
+            position[inner] += parabolic_offset(levels[:, 0], levels[:, 1], levels[:, 2])
+
+    return positions
+
 
 class ToneExtraction:
     """Extracts tones from an audio file."""
 
-    def __init__(self, config_data, audio_segment):
+    def __init__(self, config_data, audio_segment=None, samples=None, sample_rate=None, talkgroup=None,
+                 sequential_quick_call=False, spectrum_batcher=None, known_frequencies=None, known_samples=0):
         self.qcii = [288.5, 296.5, 304.7, 313.8, 321.7, 330.5, 339.6, 349.0, 358.6, 368.5, 378.6, 389.0, 399.8, 410.8,
                      422.1, 433.7, 445.7, 457.9, 470.5, 483.5, 496.8, 510.5, 524.6, 539.0, 553.9, 569.1, 584.8, 600.9,
                      617.4, 634.5, 651.9, 669.9, 688.3, 707.3, 726.8, 746.8, 767.4, 788.5, 810.2, 832.5, 855.5, 879.0,
@@ -23,86 +158,109 @@ class ToneExtraction:
                      (941, 1477): "#",
                      (697, 1633): "A", (770, 1633): "B", (852, 1633): "C", (941, 1633): "D"}
         self.audio_segment = audio_segment
+        self.samples = samples
+        self.sample_rate = sample_rate
         self.config_data = config_data
+        # Talkgroup the call came from, selects its head scan window
+        self.talkgroup = talkgroup
+        # Set when A/B then C/D detectors are configured, the second Quick Call pair can be anywhere after the first
+        self.sequential_quick_call = sequential_quick_call
+        # SpectrumBatcher shared by the extractions of concurrent uploads, None transforms in this thread
+        self.spectrum_batcher = spectrum_batcher
+        # Per frame frequencies main() found for the first known_samples samples (at the analysis rate) followed by
+        # silence, e.g. the first half of a stitched split call. Frames within them aren't analysed again.
+        self.known_frequencies = known_frequencies
+        self.known_samples = known_samples
+        # Per frame frequencies from the start of the audio, set by main() and as far as the head scan got
+        self.frame_frequencies = None
 
     def load_audio(self, audio_segment):
         audio = audio_segment
         audio = audio.set_channels(1)  # Ensure the audio is mono
-        audio = audio.set_frame_rate(22050)  # Set the frame rate to 22050 Hz
-        samples = np.array(audio.get_array_of_samples()).astype(np.float32)
-        samples /= np.iinfo(audio.sample_width * 8 - 1).max
-        return samples, audio.frame_rate, audio.duration_seconds
+        samples = np.array(audio.get_array_of_samples(), dtype=np.float32)
+        samples /= 2 ** (audio.sample_width * 8 - 1)
+
+        # Every tone we detect is under 2.6 kHz, decimate to the analysis rate (8 kHz by default)
+        rate = analysis_rate(self.config_data)
+        samples = resample_audio(samples, audio.frame_rate, rate)
+        return samples, rate, audio.duration_seconds
+
+    def load_samples(self, samples, sample_rate):
+        # Samples already decoded to mono float32, only resample if they aren't at the analysis rate
+        rate = analysis_rate(self.config_data)
+        return resample_audio(samples, sample_rate, rate), rate, len(samples) / sample_rate
+
+    def stft_parameters(self, rate, time_resolution_ms=None):
+        settings = self.config_data["tone_extraction"]
+        # Configured FFT length, or the smallest fast length with the reference frequency resolution at this rate
+        n_fft = settings.get("n_fft", 0) or next_fast_len(int(np.ceil(rate * reference_n_fft / reference_rate)),
+                                                          real=True)
+
+        # Calculate hop_length based on the desired time resolution
+        hop_length = int(rate * (time_resolution_ms or settings.get("hop_ms", 100)) // 1000)
+        return int(n_fft), hop_length
+
+    def frames_for(self, ms):
+        # Frames spanning ms milliseconds at the configured hop, the tone rules below are durations in 100 ms frames
+        return max(1, round(ms / self.config_data["tone_extraction"].get("hop_ms", 100)))
+
+    def find_long_tones(self, runs, final_list):
+        if len(runs) == 0:
+            return []
+
+        excluded_frequencies = [tt["actual"][0] for tt in final_list] + [tt["actual"][1] for tt in final_list]
+
+        # Long tones are runs of at least 1.5 seconds that aren't silence or part of a Quick Call pair.
+        frequencies = runs["frequency"]
+        long_runs = runs[(runs["length"] >= self.frames_for(1500)) & (frequencies > 250) &
+                         ~np.isin(frequencies, excluded_frequencies)]
 
-    def find_long_tones(self, matches, final_list):
-        tone_id = 0
         long_matches = []
-        excluded_frequencies = []
-        if not matches:
-            return long_matches
-        last_set = matches[0]
-        for tt in final_list:
-            if tt["actual"][0] not in excluded_frequencies:
-                excluded_frequencies.append(tt["actual"][0])
-            if tt["actual"][1] not in excluded_frequencies:
-                excluded_frequencies.append(tt["actual"][1])
-
-        for x in matches:
-            if len(x[1]) >= 8:
-                match_found = False
-                if 12 >= len(last_set) >= 8 and len(x[1]) >= 20:
-                    last_set = x[1]
-                elif len(x[1]) >= 15:
-                    if x[1][0] == 0 or x[1][0] == 0.0:
-                        continue
-                    if x[1][0] in excluded_frequencies:
-                        continue
-
-                    if x[1][0] > 250:
-                        tone_data = {"tone_id": f'lg_{tone_id + 1}', "actual": x[1][0], "occurred": round(x[0], 2)}
-                        tone_id += 1
-                        long_matches.append(tone_data)
+        for tone_id, run in enumerate(long_runs):
+            tone_data = {"tone_id": f'lg_{tone_id + 1}', "actual": float(run["frequency"]),
+                         "occurred": round(float(run["time"]), 2)}
+            long_matches.append(tone_data)
 
         return long_matches
 
-    def find_hi_low_matches(self, lst):
+    def find_hi_low_matches(self, runs):
         detected = True
-        tone_id = 0
         final_results = []
-        result = []
-        if not lst:
+        if len(runs) == 0:
             return []
-        current_time = lst[0][0]
-        current_group = [(lst[0][0], lst[0][1])]
-        for i in range(1, len(lst)):
-            if lst[i][0] - current_time <= 0.35:
-                current_group.append((lst[i][0], lst[i][1]))
-                current_time = lst[i][0]
-            else:
-                result.append(current_group)
-                current_time = lst[i][0]
-                current_group = [(lst[i][0], lst[i][1])]
-        result.append(current_group)
 
-        tuples_to_check = []
-        for pd in result:
-            if len(pd) >= 6:
-                tuples_to_check.append(pd)
+        # Runs starting within 350ms of the previous run belong to the same group
+        times = runs["time"]
+        frequencies = runs["frequency"]
+        group_starts = np.concatenate(([0], np.flatnonzero(np.diff(times) > 0.35) + 1))
+        group_ends = np.append(group_starts[1:], len(runs))
+
+        for start, end in zip(group_starts, group_ends):
+            if end - start < 6:
+                continue
 
-        for ct in tuples_to_check:
-            for i in range(0, len(ct) - 2):
-                if ct[i][1][0] != ct[i + 2][1][0]:
-                    detected = False
+            # Every run must match the run two before it, alternating hi, low, hi, low...
+            group = frequencies[start:end]
+            if not self.same_tones(group[:-2], group[2:]):
+                detected = False
 
             if detected:
-                # first = ct[0][1][0]
-                # second = ct[1][1][0]
-                tone_data = {"tone_id": f'hl_{tone_id + 1}', "actual": [ct[0][1][0], ct[1][1][0]],
-                             "occurred": round(ct[0][0], 2)}
-                tone_id += 1
+                tone_data = {"tone_id": f'hl_{len(final_results) + 1}',
+                             "actual": [float(group[0]), float(group[1])],
+                             "occurred": round(float(times[start]), 2)}
                 final_results.append(tone_data)
 
         return final_results
 
+    def same_tones(self, frequencies, other_frequencies):
+        # Runs of one tone land on the same bin, interpolated frequencies of one tone differ slightly from run to run
+        # so those match within threshold_percent
+        settings = self.config_data["tone_extraction"]
+        if settings.get("stft", {}).get("interpolation", "bin") == "bin":
+            return bool(np.all(np.asarray(frequencies) == other_frequencies))
+        threshold = np.asarray(other_frequencies) * settings["threshold_percent"] / 100
+        return bool(np.all(np.abs(np.asarray(frequencies) - other_frequencies) <= threshold))
+
     def closest_match(self, target):
         self.qcii.sort()
         closest = self.qcii[0]
@@ -114,150 +272,604 @@ class ToneExtraction:
                 smallest_difference = difference
         return closest
 
-    def normalize_qc2_matches(self, matches, threshold_percent):
+    def normalize_qc2_matches(self, runs, threshold_percent):
         qc2_matches = []
-        tone_id = 0
-        last_set = None
-        for x in matches:
-            if last_set is None:
-                last_set = x
-            else:
-                if len(x[1]) >= 8:
-                    match_found = False
-                    for q in self.qcii:
-                        if abs(x[1][0] - q) <= q * (threshold_percent / 100):
-                            match_found = True
-                            break
-                    if match_found:
-                        # check for long set
-                        if len(last_set[1]) <= 12 and len(x[1]) >= 28:
-                            a_tone_exact = self.closest_match(last_set[1][0])
-                            b_tone_exact = self.closest_match(x[1][0])
-                            a_tone_actual = last_set[1][0]
-                            b_tone_actual = x[1][0]
-                            tone_data = {"tone_id": f'qc_{tone_id + 1}', "exact": [a_tone_exact, b_tone_exact],
-                                         "actual": [a_tone_actual, b_tone_actual], "occured": round(last_set[0], 2)}
-                            tone_id += 1
-                            # exact = [a_tone_exact, b_tone_exact]
-                            # actual = [a_tone_actual, b_tone_actual]
-                            # start_time = last_set[0]
-                            qc2_matches.append(tone_data)
-                            last_set = x
-                        else:
-                            # set as last set and check next time for matching tone.
-                            last_set = x
-                    else:
-                        continue
+        if len(runs) == 0:
+            return qc2_matches
+
+        # Runs of 800+ ms within threshold_percent of a QCII frequency are tone candidates.
+        qcii = np.array(self.qcii)
+        lengths = runs["length"]
+        near_qcii = np.any(np.abs(runs["frequency"][:, None] - qcii) <= qcii * (threshold_percent / 100), axis=1)
+        candidates = np.flatnonzero((lengths >= self.frames_for(800)) & near_qcii)
+        candidates = candidates[candidates > 0]
+
+        # Each candidate is paired with the candidate before it (the first run seeds the pairing),
+        # a short A tone followed by a long B tone is a match.
+        previous = np.concatenate(([0], candidates[:-1]))
+        # A seed run at 0 Hz is silence (or, with the goertzel engine, audio that isn't tonal), never an A tone
+        is_pair = ((lengths[previous] <= self.frames_for(1200)) & (lengths[candidates] >= self.frames_for(2800)) &
+                   (runs["frequency"][previous] > 0))
+
+        for tone_id, (a_index, b_index) in enumerate(zip(previous[is_pair], candidates[is_pair])):
+            a_tone_actual = float(runs["frequency"][a_index])
+            b_tone_actual = float(runs["frequency"][b_index])
+            tone_data = {"tone_id": f'qc_{tone_id + 1}',
+                         "exact": [self.closest_match(a_tone_actual), self.closest_match(b_tone_actual)],
+                         "actual": [a_tone_actual, b_tone_actual],
+                         "occured": round(float(runs["time"][a_index]), 2)}
+            qc2_matches.append(tone_data)
 
         return qc2_matches
 
-    def match_frequencies(self, frequencies, file_duration, threshold_percent):
-        # Round frequencies to 2 decimal places
-        frequencies = [round(f, 1) for f in frequencies]
-
-        # Initialize variables
-        matching_frequencies = []
-        current_match = [frequencies[0]]
-        start_time = 0
-
-        # Iterate over frequencies, checking for matches
-        for i in range(1, len(frequencies)):
-
-            # Calculate the threshold for the current frequency
-            threshold = frequencies[i - 1] * threshold_percent / 100
-
-            # Check if frequency is within the threshold of the previous frequency
-            if abs(frequencies[i] - frequencies[i - 1]) <= threshold:
-                # If it is, add it to the current match
-                current_match.append(frequencies[i])
-
-            # If frequency is not within the threshold of the previous frequency, start a new match
-            else:
-                # If the match has been going on for the desired duration, add it to the list of matches
-                if len(current_match) >= 2:
-                    matching_frequencies.append((start_time, current_match))
-                current_match = [frequencies[i]]
-                start_time = i * file_duration / len(frequencies)
-
-        return matching_frequencies
-
-    def amplitude_to_db(self, amplitude, ref):
-        return 20 * np.log10(np.maximum(amplitude, 1e-20) / ref)
-
-    def detect_tones(self, audio_data, rate, time_resolution_ms=100):
-        window = 'hann'
-        n_fft = 2048
-
-        # Calculate hop_length based on the desired time resolution
-        hop_length = rate * time_resolution_ms // 1000
-
-        f, t, Zxx = stft(audio_data, rate, window=window, nperseg=n_fft, noverlap=n_fft - hop_length)
-        amplitude = np.abs(Zxx)
-        amplitude_db = self.amplitude_to_db(amplitude, np.max(amplitude))
-
-        detected_frequencies = f[np.argmax(amplitude_db, axis=0)]
-
-        return detected_frequencies
-
-    def detect_key_presses(self, data, fps, duration, precision=0.04, freq_error=20):
+    def split_runs(self, frequencies, threshold_percent):
+        """
+        Splits per frame frequencies into runs of frames within threshold_percent of the frame before.
+
+        Returns:
+            tuple: (frequencies rounded to 1 decimal place, run start frames, run lengths)
+        """
+        frequencies = np.round(np.asarray(frequencies, dtype=np.float64), 1)
+        breaks = np.abs(np.diff(frequencies)) > frequencies[:-1] * threshold_percent / 100
+        starts = np.concatenate(([0], np.flatnonzero(breaks) + 1))
+        lengths = np.diff(np.append(starts, len(frequencies)))
+        return frequencies, starts, lengths
+
+    def match_frequencies(self, frequencies, file_duration, threshold_percent, frame_total=None):
+        # frame_total is the frame count of the whole file when only its head was analysed, times stay the same
+        if len(frequencies) == 0:
+            return np.empty(0, dtype=tone_run_dtype)
+        frame_total = frame_total or len(frequencies)
+
+        # A new run starts wherever a frame moves more than threshold_percent away from the previous frame
+        frequencies, starts, lengths = self.split_runs(frequencies, threshold_percent)
+
+        # Keep runs of at least 200 ms, the run still open at the end of the audio is never closed.
+        keep = lengths[:-1] >= self.frames_for(200)
+        starts = starts[:-1][keep]
+
+        runs = np.empty(len(starts), dtype=tone_run_dtype)
+        runs["start"] = starts
+        runs["length"] = lengths[:-1][keep]
+        runs["frequency"] = frequencies[starts]
+        runs["time"] = starts * file_duration / frame_total
+
+        return runs
+
+    def detect_tones(self, audio_data, rate, time_resolution_ms=None, frames=None):
+        n_fft, hop_length = self.stft_parameters(rate, time_resolution_ms)
+        audio_data = audio_data.astype(np.float32, copy=False)
+        window = hann_window(n_fft)
+        if frames is None:
+            frames = slice(0, self.frame_count(len(audio_data), n_fft, hop_length))
+
+        # Hann windowed frames cut exactly as scipy's stft cuts them
+        interpolation = self.config_data["tone_extraction"].get("stft", {}).get("interpolation", "bin")
+        if self.spectrum_batcher is not None and interpolation != "phase":
+            position = self.spectrum_batcher.peaks(self._frame_matrix(audio_data, n_fft, hop_length, frames), window,
+                                                   interpolation)
+        else:
+            # A block of frames at a time, only the blocks at either end of the call need a padded copy
+            position = np.empty(frames.stop - frames.start, dtype=np.float64)
+            for start in range(frames.start, frames.stop, 1024):
+                block = slice(start, min(start + 1024, frames.stop))
+                position[start - frames.start:block.stop - frames.start] = frame_peaks(
+                    self._frame_matrix(audio_data, n_fft, hop_length, block), window, interpolation)
+
+        if interpolation == "phase":
+            return self._phase_frequencies(audio_data, rate, n_fft, hop_length, frames, position.astype(np.int64))
+        return position * rate / n_fft
+
+    def _phase_frequencies(self, audio_data, rate, n_fft, hop_length, frames, peak):
+        """
+        Instantaneous frequency at the peak bin of every frame from the phase advance over one sample.
+
+        The peak bin of each frame and of the same frame one sample later are evaluated directly (a single DFT
+        bin each), the phase turns by 2*pi*f/rate between the two. Unlike the phase advance between hops this is
+        never ambiguous.
+        """
+        if n_fft not in dft_bases:
+            phase = -2 * np.pi * np.outer(np.arange(n_fft // 2 + 1), np.arange(n_fft)) / n_fft
+            dft_bases[n_fft] = (np.exp(1j * phase) * hann_window(n_fft)).astype(np.complex64)
+        basis = dft_bases[n_fft]
+
+        # Framed by slice, the audio one sample on is a view and the sample past the end is zero filled
+        lagged_audio = audio_data[1:]
+        advance = np.empty(len(peak), dtype=np.float64)
+        for start in range(frames.start, frames.stop, 1024):
+            block = slice(start, min(start + 1024, frames.stop))
+            rows = slice(start - frames.start, block.stop - frames.start)
+            kernel = basis[peak[rows]]
+            values = np.einsum('ij,ij->i', self._frame_matrix(audio_data, n_fft, hop_length, block), kernel)
+            lagged_values = np.einsum('ij,ij->i', self._frame_matrix(lagged_audio, n_fft, hop_length, block), kernel)
+            advance[rows] = np.angle(lagged_values * np.conj(values))
+        return np.mod(advance, 2 * np.pi) * rate / (2 * np.pi)
+
+    def _frame_signal(self, audio_data, n_fft, hop_length):
+        # Pad the same way scipy's stft does (boundary zeros + trailing pad) so frame counts and times line up.
+        padded_length = len(audio_data) + 2 * (n_fft // 2)
+        extra = (-(padded_length - n_fft) % hop_length) % n_fft
+        padded = np.pad(audio_data, (n_fft // 2, n_fft // 2 + extra))
+        return sliding_window_view(padded, n_fft)[::hop_length]
+
+    def _frame_matrix(self, audio_data, n_fft, hop_length, frames=None):
+        # All frames of the padded signal, or only frames[start:stop] of them, as rows of a view
+        if frames is None:
+            return self._frame_signal(audio_data, n_fft, hop_length)
+        return sliding_window_view(self._frame_segment(audio_data, n_fft, hop_length, frames), n_fft)[::hop_length]
+
+    def frame_count(self, sample_count, n_fft, hop_length):
+        # Number of frames _frame_signal (and scipy's stft) produce for sample_count samples
+        padded_length = sample_count + 2 * (n_fft // 2)
+        extra = (-(padded_length - n_fft) % hop_length) % n_fft
+        return (padded_length + extra - n_fft) // hop_length + 1
+
+    def _frame_segment(self, audio_data, n_fft, hop_length, frames):
+        # Samples under frames[start:stop] of the padded signal, zero filled where they hang past either end
+        start = frames.start * hop_length - n_fft // 2
+        stop = (frames.stop - 1) * hop_length - n_fft // 2 + n_fft
+        segment = audio_data[max(start, 0):max(min(stop, len(audio_data)), 0)]
+        if start >= 0 and stop <= len(audio_data):
+            return segment
+        return np.pad(segment, (max(-start, 0), max(stop - max(start, len(audio_data)), 0)))
+
+    def _goertzel_basis(self, rate, length, threshold_percent):
+        """
+        Goertzel filter bank of detect_tones_goertzel for window length at rate.
+
+        Probes sit on every QCII table frequency and pick the table frequency a tone is closest to. Where
+        threshold_percent of a table frequency is wider than a bin of the window, the upper end of the table,
+        neighbour probes at either end of the tolerance catch detuned transmitters outside its main lobe.
+
+        Returns:
+            tuple: (QCII table frequencies, window, cosine and sine basis of the table probes then the neighbours)
+        """
+        key = (rate, length, threshold_percent)
+        if key not in goertzel_basis_cache:
+            table = np.array(self.qcii, dtype=np.float64)
+            tolerance = table * threshold_percent / 100
+            wide = tolerance > rate / length
+            probes = np.concatenate((table, table[wide] - tolerance[wide], table[wide] + tolerance[wide]))
+            window = get_window('hann', length).astype(np.float32)
+            phase = 2 * np.pi * np.outer(np.arange(length), probes) / rate
+            basis = np.concatenate((np.cos(phase), np.sin(phase)), axis=1).astype(np.float32)
+            goertzel_basis_cache[key] = (table, window, basis)
+        return goertzel_basis_cache[key]
+
+    def detect_tones_goertzel(self, audio_data, rate, time_resolution_ms=None, tonal_ratio=0.05, window_ms=32,
+                              frames=None):
+        """
+        Nearest QCII table frequency per frame from a Goertzel filter bank, 0 for frames that aren't tonal.
+
+        Frames are on the same grid as detect_tones, so per frame times are identical between engines, but each
+        probe only needs its main lobe to peak on the closest table frequency, so it looks at the window_ms in the
+        middle of the frame rather than all of it. Only Quick Call matching can use this, every other frequency
+        comes out as the nearest table frequency or 0.
+        """
+        n_fft, hop_length = self.stft_parameters(rate, time_resolution_ms)
+        length = int(min(n_fft, max(1, rate * window_ms // 1000)))
+        offset = (n_fft - length) // 2
+        frames = self._frame_matrix(audio_data.astype(np.float32, copy=False), n_fft, hop_length,
+                                    frames)[:, offset:offset + length]
+
+        # Goertzel filter bank evaluated for every frame at once
+        table, window, basis = self._goertzel_basis(rate, length,
+                                                    self.config_data["tone_extraction"]["threshold_percent"])
+        windowed = frames * window
+        response = windowed @ basis
+        probes = basis.shape[1] // 2
+        power = np.square(response[:, :probes]) + np.square(response[:, probes:])
+        peak = np.argmax(power[:, :len(table)], axis=1)
+
+        # A pure tone puts about a third of the windowed frame energy into its probe (length scaled),
+        # noise and voice spread it out. Frames below tonal_ratio of that report 0 like silence does with the STFT.
+        frame_energy = np.einsum('ij,ij->i', windowed, windowed) * length
+        tonal = np.max(power, axis=1) > tonal_ratio * frame_energy
+
+        return np.where(tonal, table[peak], 0.0)
+
+    def _peak_concentration(self, power):
+        # Strongest bin of every row and the share of the row's power in it and the bins either side
+        peak = np.argmax(power, axis=1)
+        padded = np.pad(power, ((0, 0), (1, 1)))
+        rows = np.arange(len(power))
+        peak_power = padded[rows, peak] + padded[rows, peak + 1] + padded[rows, peak + 2]
+        return peak, peak_power / np.maximum(power.sum(axis=1), 1e-30)
+
+    def _coarse_peaks(self, audio_data, rate, coarse_n_fft, hop_length, band, concentration, frames):
+        """
+        Coarse stage of detect_tones_coarse_to_fine for frames[start:stop].
+
+        Returns:
+            tuple: (peak frequency interpolated between bins, tonal flag) per frame
+        """
+        blocks = self._frame_matrix(audio_data, coarse_n_fft, hop_length, frames)
+        window = get_window('hann', coarse_n_fft).astype(np.float32)
+        power = np.abs(rfft(blocks * window, axis=1)[:, band]) ** 2
+        peak, peak_share = self._peak_concentration(power)
+
+        # Parabola through the log power of the peak and its neighbours, good to a fraction of a bin
+        rows = np.arange(len(power))
+        log_power = np.log(np.pad(power, ((0, 0), (1, 1)), mode='edge') + 1e-30)
+        left, center, right = log_power[rows, peak], log_power[rows, peak + 1], log_power[rows, peak + 2]
+        curvature = left - 2 * center + right
+        offset = np.divide(0.5 * (left - right), curvature, out=np.zeros_like(center), where=curvature < 0)
+        frequency = (band.start + peak + np.clip(offset, -0.5, 0.5)) * rate / coarse_n_fft
+
+        return frequency, peak_share > concentration
+
+    def _zoom_transform(self, rate, length, points, resolution):
+        # Zoom FFT from 0 Hz in resolution steps, signals are shifted down to the band of interest before it
+        key = (rate, length, points, resolution)
+        if key not in zoom_transform_cache:
+            zoom_transform_cache[key] = (ZoomFFT(length, [0, (points - 1) * resolution], points, fs=rate,
+                                                 endpoint=True),
+                                         get_window('hann', length).astype(np.float32))
+        return zoom_transform_cache[key]
+
+    def detect_tones_coarse_to_fine(self, audio_data, rate, time_resolution_ms=None, frames=None):
+        """
+        Peak frequency per frame in two stages, on the same frame grid as detect_tones.
+
+        The coarse stage is a short FFT (coarse_n_fft) centred on every frame. Frames whose band energy sits
+        around one peak are tonal, and consecutive tonal frames with peaks within threshold_percent of each other
+        form a region. The fine stage is one zoom FFT per region over the audio the region spans (at most the
+        middle fine_span_ms of it), covering a coarse bin either side of its peak at fine_resolution Hz steps.
+        Voice and noise frames, usually most of a call, only get the short transform. Every frame of a region
+        reports the region's frequency, measured over the whole tone instead of one ~10.7 Hz bin of one frame,
+        which is what closest_match needs to tell QCII neighbours like 979.9 and 989.0 apart.
+
+        Returns:
+            numpy.ndarray: Peak frequency per frame, -1 for frames that aren't tonal. A negative frequency breaks
+                the run on every frame in match_frequencies, so voice and noise never form runs that could join
+                a hi-low group.
+        """
+        settings = self.config_data["tone_extraction"].get("coarse_to_fine", {})
+        threshold_percent = self.config_data["tone_extraction"]["threshold_percent"]
+        concentration = settings.get("concentration", 0.35)
+        resolution = settings.get("fine_resolution", 1.0)
+        span_limit = int(rate * settings.get("fine_span_ms", 500) / 1000)
+        low_frequency, high_frequency = settings.get("band", [250, 2700])
+
+        n_fft, hop_length = self.stft_parameters(rate, time_resolution_ms)
+        coarse_n_fft = min(settings.get("coarse_n_fft", 256), n_fft)
+        audio_data = audio_data.astype(np.float32, copy=False)
+        frame_total = self.frame_count(len(audio_data), n_fft, hop_length)
+        frames = frames or slice(0, frame_total)
+
+        coarse_frequencies = rfftfreq(coarse_n_fft, d=1 / rate)
+        band = slice(np.searchsorted(coarse_frequencies, low_frequency),
+                     np.searchsorted(coarse_frequencies, high_frequency, 'right'))
+
+        def coarse(start, stop):
+            return self._coarse_peaks(audio_data, rate, coarse_n_fft, hop_length, band, concentration,
+                                      slice(start, stop))
+
+        def linked(frequency, tonal):
+            # Frames continuing the region of the frame before them, both tonal and within threshold_percent
+            # of each other, the same rule match_frequencies splits runs by
+            close = np.abs(np.diff(frequency)) <= frequency[:-1] * threshold_percent / 100
+            return np.concatenate(([False], tonal[1:] & tonal[:-1] & close))
+
+        # Regions crossing either end of the requested frames are followed to their real ends, so a region's
+        # frequency doesn't depend on where the frames were cut
+        first, last = frames.start, frames.stop
+        frequency, tonal = coarse(first, last)
+        while first > 0 and tonal[0]:
+            block_frequency, block_tonal = coarse(max(0, first - 64), first)
+            first -= len(block_frequency)
+            frequency = np.concatenate((block_frequency, frequency))
+            tonal = np.concatenate((block_tonal, tonal))
+            if not np.all(linked(frequency, tonal)[1:len(block_frequency) + 1]):
+                break
+        while last < frame_total and tonal[-1]:
+            block_frequency, block_tonal = coarse(last, min(frame_total, last + 64))
+            last += len(block_frequency)
+            frequency = np.concatenate((frequency, block_frequency))
+            tonal = np.concatenate((tonal, block_tonal))
+            if not np.all(linked(frequency, tonal)[-len(block_frequency):]):
+                break
+
+        # A tone has to last two frames to form a run, shorter regions aren't worth measuring
+        links = linked(frequency, tonal)
+        starts = np.flatnonzero(tonal & ~links)
+        breaks = np.append(np.flatnonzero(~links), len(links))
+        ends = breaks[np.searchsorted(breaks, starts, side='right')]
+        starts, ends = starts[ends - starts >= 2], ends[ends - starts >= 2]
+
+        detected_frequencies = np.full(last - first, -1.0)
+        bin_width = rate / coarse_n_fft
+        points = int(round(2 * bin_width / resolution)) + 1
+        for start, end in zip(starts, ends):
+            # Fine stage over the audio between the first and last frame's coarse blocks, shifted down so the
+            # zoom starts at 0 Hz and the transform only depends on the span's length
+            span = self._frame_segment(audio_data, coarse_n_fft, hop_length, slice(first + start, first + end))
+            trim = max(0, len(span) - span_limit) // 2
+            span = span[trim:len(span) - trim]
+            low = np.floor((np.median(frequency[start:end]) - bin_width) / resolution) * resolution
+            zoom, window = self._zoom_transform(rate, len(span), points, resolution)
+            shift = np.exp(-2j * np.pi * low / rate * np.arange(len(span)))
+            spectrum = np.abs(zoom(span * window * shift))
+            detected_frequencies[start:end] = low + np.argmax(spectrum) * resolution
+
+        return detected_frequencies[frames.start - first:frames.stop - first]
+
+    def snap_to_tones(self, peaks, tones, freq_error):
+        # Snap each peak to the nearest tone closer than freq_error Hz, 0 when none is.
+        distance = np.abs(peaks[:, None] - tones)
+        nearest = np.argmin(distance, axis=1)
+        in_range = distance[np.arange(len(peaks)), nearest] < freq_error
+        return np.where(in_range, tones[nearest], 0)
+
+    def key_press_windows(self, sample_count, duration, precision=0.04):
+        # (step, count) of the precision sized windows detect_key_presses cuts sample_count samples into
+        step = int(sample_count // (duration // precision))
+        return step, len(range(0, sample_count - step, step))
+
+    def detect_key_presses(self, data, fps, duration, precision=0.04, freq_error=20, block_size=1024, windows=None):
+
+        step, window_count = self.key_press_windows(len(data), duration, precision)
+        if window_count < 1:
+            return []
 
-        step = int(len(data) // (duration // precision))
+        # Non overlapping precision sized windows stacked as rows of one matrix (a view, no copy)
+        key_windows = data[:window_count * step].reshape(window_count, step)
+        first_window = 0
+        if windows is not None:
+            # Only windows[start:stop], timed as if the whole file was scanned
+            key_windows = key_windows[windows]
+            first_window = windows.start
+        frequencies = np.fft.rfftfreq(step, d=1 / fps)
+
+        # Low group is (0, 1050] Hz, high group is (1100, 2000] Hz
+        low_band = slice(np.flatnonzero(frequencies > 0)[0], np.flatnonzero(frequencies > 1050)[0])
+        high_band = slice(np.flatnonzero(frequencies > 1100)[0], np.flatnonzero(frequencies > 2000)[0])
+        low_tones = np.array([697, 770, 852, 941])
+        high_tones = np.array([1209, 1336, 1477, 1633])
 
         key_presses = []
-        for i in range(0, len(data) - step, step):
-            signal = data[i:i + step]
-
-            frequencies = np.fft.fftfreq(signal.size, d=1 / fps)
-            amplitudes = np.fft.fft(signal)
-
-            # Low frequency
-            i_min = np.where(frequencies > 0)[0][0]
-            i_max = np.where(frequencies > 1050)[0][0]
-
-            freq = frequencies[i_min:i_max]
-            amp = abs(amplitudes.real[i_min:i_max])
+        # Windows are transformed in blocks to keep the spectrum matrix small on long calls
+        for block_start in range(0, len(key_windows), block_size):
+            amplitudes = np.abs(np.fft.rfft(key_windows[block_start:block_start + block_size], axis=1).real)
 
-            lf = freq[np.where(amp == max(amp))[0][0]]
+            lf = frequencies[low_band][np.argmax(amplitudes[:, low_band], axis=1)]
+            hf = frequencies[high_band][np.argmax(amplitudes[:, high_band], axis=1)]
+            lf = self.snap_to_tones(lf, low_tones, freq_error)
+            hf = self.snap_to_tones(hf, high_tones, freq_error)
 
-            delta = freq_error
-            best = 0
+            for window_index in np.flatnonzero((lf != 0) & (hf != 0)):
+                i = (first_window + block_start + int(window_index)) * step
+                t = int(i // step * precision)
+                current_time = i * 1000 / fps
 
-            for f in [697, 770, 852, 941]:
-                if abs(lf - f) < delta:
-                    delta = abs(lf - f)
-                    best = f
-
-            lf = best
-
-            # High frequency
-            i_min = np.where(frequencies > 1100)[0][0]
-            i_max = np.where(frequencies > 2000)[0][0]
-
-            freq = frequencies[i_min:i_max]
-            amp = abs(amplitudes.real[i_min:i_max])
-
-            hf = freq[np.where(amp == max(amp))[0][0]]
-
-            delta = freq_error
-            best = 0
-
-            for f in [1209, 1336, 1477, 1633]:
-                if abs(hf - f) < delta:
-                    delta = abs(hf - f)
-                    best = f
-
-            hf = best
-
-            t = int(i // step * precision)
-            current_time = i * 1000 / fps
-
-            if lf != 0 and hf != 0:
-                current_key = self.dtmf[(lf, hf)]
+                current_key = self.dtmf[(int(lf[window_index]), int(hf[window_index]))]
                 current_press = {"key": current_key, "time": t, "ms_time": current_time}
                 key_presses.append(current_press)
 
         return key_presses
 
+    def has_tonal_energy(self, audio_data, rate, block_size=4096):
+        """
+        Cheap pre-screen for narrowband tones in the paging band, so tone-free calls can skip full extraction.
+
+        The audio is cut into short non overlapping Hann windowed blocks. A block is tonal when the 3 bins around
+        its strongest in-band peak hold at least `concentration` of the band's energy, and its band spectrum is at
+        least `similarity` alike (cosine) to the previous block's. Tones are loud and steady, voiced speech can be
+        as concentrated for a block but its formants move from one block to the next. Tones are present when
+        min_tone_ms of consecutive blocks are tonal.
+
+        Args:
+            audio_data (numpy.ndarray): Mono float samples.
+            rate (int): Sample rate of audio_data.
+            block_size (int): Blocks transformed per rFFT call, bounds memory on long calls.
+
+        Returns:
+            bool: True if the audio may contain tones and needs full extraction.
+        """
+        settings = self.config_data["tone_extraction"].get("pre_screen", {})
+        block_ms = settings.get("block_ms", 32)
+        min_tone_ms = settings.get("min_tone_ms", 96)
+        concentration = settings.get("concentration", 0.35)
+        similarity = settings.get("similarity", 0.9)
+        low_frequency, high_frequency = settings.get("band", [280, 2600])
+
+        block_length = int(rate * block_ms / 1000)
+        block_count = len(audio_data) // block_length
+        min_blocks = max(1, ceil(min_tone_ms / block_ms))
+        if block_count < min_blocks + 1:
+            return True
+
+        blocks = audio_data[:block_count * block_length].reshape(block_count, block_length)
+        window = get_window('hann', block_length).astype(np.float32)
+        frequencies = rfftfreq(block_length, d=1 / rate)
+        band = slice(np.searchsorted(frequencies, low_frequency), np.searchsorted(frequencies, high_frequency, 'right'))
+
+        tonal = np.zeros(block_count, dtype=bool)
+        previous_shape = None
+        for start in range(0, block_count, block_size):
+            power = np.abs(rfft(blocks[start:start + block_size] * window, axis=1)[:, band]) ** 2
+            peak, peak_share = self._peak_concentration(power)
+
+            # Unit length band spectra, the dot product of neighbours is their cosine similarity
+            shape = power / np.maximum(np.linalg.norm(power, axis=1, keepdims=True), 1e-30)
+            steady = np.zeros(len(power), dtype=bool)
+            steady[1:] = np.einsum('ij,ij->i', shape[1:], shape[:-1]) > similarity
+            if previous_shape is not None:
+                steady[0] = np.dot(shape[0], previous_shape) > similarity
+            previous_shape = shape[-1]
+
+            tonal[start:start + block_size] = (peak_share > concentration) & steady
+
+        # Any window of min_blocks consecutive tonal blocks
+        tonal_runs = np.convolve(tonal, np.ones(min_blocks, dtype=int), mode='valid')
+        return bool(np.any(tonal_runs >= min_blocks))
+
+    def goertzel_applies(self):
+        """
+        Whether detect_frequencies can use the goertzel engine. It only reports QCII table frequencies, long and
+        hi-low tone detection need the STFT's peaks, so it applies only with both disabled. Both are enabled in the
+        default configuration, where engine "goertzel" runs the stft engine until they're turned off.
+        """
+        settings = self.config_data["tone_extraction"]
+        return not (settings.get("long_tone", {}).get("enabled", 1) or
+                    settings.get("hi-low_tone", {}).get("enabled", 1))
+
+    def detect_frequencies(self, audio_data, rate, frames=None):
+        # Peak frequency per frame with the configured engine, frames selects a slice of the whole signal's frames
+        global goertzel_fallback_logged
+        settings = self.config_data["tone_extraction"]
+        if settings.get("engine", "stft") == "coarse_to_fine":
+            return self.detect_tones_coarse_to_fine(audio_data, rate, frames=frames)
+        if settings.get("engine", "stft") == "goertzel":
+            if self.goertzel_applies():
+                return self.detect_tones_goertzel(audio_data, rate,
+                                                  tonal_ratio=settings.get("goertzel", {}).get("tonal_ratio", 0.05),
+                                                  window_ms=settings.get("goertzel", {}).get("window_ms", 32),
+                                                  frames=frames)
+            if not goertzel_fallback_logged:
+                goertzel_fallback_logged = True
+                module_logger.warning("The goertzel engine only detects Quick Call tones, using the stft engine "
+                                      "while long or hi-low tone detection is enabled. Disable both to use it.")
+        return self.detect_tones(audio_data, rate, frames=frames)
+
+    def known_frame_count(self, rate):
+        # Leading frames known_frequencies holds that lie wholly within the known samples
+        if self.known_frequencies is None or self.samples is None or self.sample_rate != rate:
+            # Resampling the stitched audio isn't sample for sample the same as resampling its parts
+            return 0
+        n_fft, hop_length = self.stft_parameters(rate)
+        return min(len(self.known_frequencies), max(0, (self.known_samples - (n_fft - n_fft // 2)) // hop_length + 1))
+
+    def analyse_frames(self, audio_data, rate, frames=None):
+        """
+        Peak frequency of frames[start:stop] (every frame when None) like detect_frequencies, frames already in
+        known_frequencies are taken from there and only the rest of the audio is analysed, on the same frame grid.
+        """
+        reusable = self.known_frame_count(rate)
+        if reusable == 0:
+            return self.detect_frequencies(audio_data, rate, frames=frames)
+
+        if frames is None:
+            n_fft, hop_length = self.stft_parameters(rate)
+            frames = slice(0, self.frame_count(len(audio_data), n_fft, hop_length))
+        known_stop = min(max(frames.start, reusable), frames.stop)
+        parts = [np.asarray(self.known_frequencies[frames.start:known_stop], dtype=np.float64)]
+        if known_stop < frames.stop:
+            parts.append(self.detect_frequencies(audio_data, rate, frames=slice(known_stop, frames.stop)))
+        return np.concatenate(parts)
+
+    def scan_window(self):
+        # Head scan window in seconds for this call's talkgroup, 0 scans the whole file at once
+        settings = self.config_data["tone_extraction"].get("head_scan", {})
+        if settings.get("enabled", 0) != 1:
+            return 0
+        return settings.get("talkgroups", {}).get(str(self.talkgroup), settings.get("window", 10))
+
+    def tones_open_at_edge(self, frequencies, frame_seconds, key_presses, edge_ms, group_seconds=0.35,
+                           key_press_threshold=250):
+        """
+        Checks whether a tone found at the end of a scanned head could carry on past it.
+
+        Args:
+            frequencies (numpy.ndarray): Per frame frequencies of the head.
+            frame_seconds (float): Seconds per frame.
+            key_presses (list): DTMF key presses found in the head.
+            edge_ms (float): Where the DTMF scan of the head ends, in milliseconds.
+            group_seconds (float): Gap within which runs join a hi-low group (see find_hi_low_matches).
+            key_press_threshold (int): Span of a DTMF key press group (see get_positive_key_presses).
+
+        Returns:
+            bool: True if the scan has to carry on into the rest of the file.
+        """
+        frequencies, starts, lengths = self.split_runs(frequencies,
+                                                       self.config_data["tone_extraction"]["threshold_percent"])
+        run_frequencies = frequencies[starts]
+
+        min_frames = self.frames_for(200)
+
+        # A tone still sounding at the edge
+        if lengths[-1] >= min_frames and run_frequencies[-1] > 250:
+            return True
+
+        # A tone that ended just before the edge, it can be the A tone of a Quick Call pair
+        tones = (lengths[:-1] >= min_frames) & (run_frequencies[:-1] > 250)
+        gaps = (len(frequencies) - 1 - (starts + lengths)[:-1]) * frame_seconds
+        if np.any(tones & (gaps <= group_seconds)):
+            return True
+
+        # An alternating hi-low group the run at the edge (of any frequency, silence included) would still join
+        kept = np.flatnonzero(lengths[:-1] >= min_frames)
+        if len(kept) >= 3 and (starts[-1] - starts[kept[-1]]) * frame_seconds <= group_seconds:
+            group_starts = starts[kept]
+            first = np.flatnonzero(np.diff(group_starts) * frame_seconds > group_seconds)
+            group = run_frequencies[kept[first[-1] + 1 if len(first) else 0:]]
+            if len(group) >= 3 and self.same_tones(group[:-2], group[2:]):
+                return True
+
+        # A DTMF press close enough to the edge for the next press to join its group
+        return bool(key_presses) and key_presses[-1]["ms_time"] >= edge_ms - key_press_threshold
+
+    def scan_head(self, audio_data, rate, file_duration, window_seconds):
+        """
+        Analyses a call window_seconds at a time from the start, stopping at the first window edge no tone carries
+        on past. Most dispatch calls have their tones in the first seconds followed by voice, which is never
+        analysed. Frames and DTMF windows are cut exactly as a full scan cuts them, so every run, key press and
+        occurred time found is identical to scanning the whole file.
+
+        Returns:
+            tuple: (per frame frequencies of the scanned head, frame count of the whole file, key presses or
+                None when DTMF is disabled)
+        """
+        settings = self.config_data["tone_extraction"]
+        n_fft, hop_length = self.stft_parameters(rate)
+        frame_total = self.frame_count(len(audio_data), n_fft, hop_length)
+        window_samples = max(int(window_seconds * rate), n_fft)
+
+        key_presses = None
+        if settings["dtmf"]["enabled"]:
+            key_presses = []
+            step, window_total = self.key_press_windows(len(audio_data), file_duration)
+
+        chunks = []
+        scanned = 0
+        frame_stop = 0
+        key_window_stop = 0
+        while True:
+            scanned = min(len(audio_data), scanned + window_samples)
+            at_end = scanned == len(audio_data)
+
+            # Frames (and DTMF windows) lying wholly inside what has been scanned so far
+            frame_start = frame_stop
+            frame_stop = frame_total if at_end else min(frame_total, max(
+                frame_start, (scanned + n_fft // 2 - n_fft) // hop_length + 1))
+            if frame_stop > frame_start:
+                chunks.append(self.analyse_frames(audio_data, rate, frames=slice(frame_start, frame_stop)))
+
+            if key_presses is not None and window_total > 0:
+                key_window_start = key_window_stop
+                key_window_stop = window_total if at_end else min(window_total, scanned // step)
+                key_presses += self.detect_key_presses(audio_data, rate, file_duration,
+                                                       windows=slice(key_window_start, key_window_stop))
+
+            frequencies = np.concatenate(chunks) if chunks else np.empty(0)
+            if at_end:
+                break
+            if len(frequencies) == 0:
+                continue
+
+            if self.sequential_quick_call and self.normalize_qc2_matches(
+                    self.match_frequencies(frequencies, file_duration, settings["threshold_percent"], frame_total), 2):
+                # The C/D pair can come any time after the A/B pair, only the whole file will do
+                window_samples = len(audio_data)
+                continue
+
+            edge_ms = key_window_stop * step * 1000 / rate if key_presses is not None else 0
+            if not self.tones_open_at_edge(frequencies, file_duration / frame_total, key_presses, edge_ms):
+                break
+
+        module_logger.debug(f"Head scan analysed {scanned / rate:.1f}s of {len(audio_data) / rate:.1f}s")
+        return frequencies, frame_total, key_presses
+
     def get_positive_key_presses(self, key_presses, threshold=250, min_presses=4):
         positive_key_presses = []
         current_group = []
@@ -284,15 +896,24 @@ class ToneExtraction:
         return positive_key_presses
 
     def main(self):
-        audio_data, rate, file_duration = self.load_audio(self.audio_segment)
-        averaged_frequencies = self.detect_tones(audio_data, rate)
+        if self.samples is not None:
+            audio_data, rate, file_duration = self.load_samples(self.samples, self.sample_rate)
+        else:
+            audio_data, rate, file_duration = self.load_audio(self.audio_segment)
 
-        # Convert the averaged frequencies NumPy array to a list
-        averaged_frequencies_list = averaged_frequencies.tolist()
+        window_seconds = self.scan_window()
+        if 0 < window_seconds < file_duration:
+            averaged_frequencies, frame_total, key_presses = self.scan_head(audio_data, rate, file_duration,
+                                                                            window_seconds)
+        else:
+            averaged_frequencies = self.analyse_frames(audio_data, rate)
+            frame_total, key_presses = None, None
+        self.frame_frequencies = averaged_frequencies
 
-        # You can print or process the averaged frequencies further as needed
-        matched_frequencies = self.match_frequencies(averaged_frequencies_list, file_duration,
-                                                     self.config_data["tone_extraction"]["threshold_percent"])
+        # Group the per frame frequencies into runs
+        matched_frequencies = self.match_frequencies(averaged_frequencies, file_duration,
+                                                     self.config_data["tone_extraction"]["threshold_percent"],
+                                                     frame_total)
 
         if self.config_data["tone_extraction"]["quick_call"]["enabled"]:
             # Find Quick Call Matches. Frequency must be +- 2% of actual QC2 Tones. Tries to match what it heard to actual QCII frequencies within +-2%
@@ -315,7 +936,8 @@ class ToneExtraction:
 
         # Find DTMF Key Presses must detect a key press for 250ms minimum and last for 1000ms. Considers 1000ms length one key press.
         if self.config_data["tone_extraction"]["dtmf"]["enabled"]:
-            key_presses = self.detect_key_presses(audio_data, rate, file_duration)
+            if key_presses is None:
+                key_presses = self.detect_key_presses(audio_data, rate, file_duration)
             dtmf_tones = self.get_positive_key_presses(key_presses)
         else:
             dtmf_tones = []
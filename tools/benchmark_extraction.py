@@ -0,0 +1,119 @@
+"""Fires bursts of simultaneous extractions over a corpus of recordings and reports latency and throughput.
+
+Each burst starts --burst extractions at the same moment, the way uploads arrive during a major incident, once
+with every extraction transforming its own frames and once sharing a SpectrumBatcher, e.g.
+
+    python tools/benchmark_extraction.py /path/to/corpus --burst 32 --rounds 5 --max-wait-ms 5
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from compare_extraction import audio_extensions, build_config, parse_settings, summarize
+from lib.audio_decode_handler import decode_audio
+from lib.config_handler import default_config
+from lib.spectrum_batch_handler import SpectrumBatcher
+from lib.tone_extraction_handler import ToneExtraction, analysis_rate
+
+
+def run_burst(config_data, calls, spectrum_batcher):
+    """
+    Runs every call in its own thread, all released together.
+
+    Returns:
+        tuple: (latency of every call in seconds, wall time of the burst in seconds, results in call order)
+    """
+    latencies = [0.0] * len(calls)
+    results = [None] * len(calls)
+    barrier = threading.Barrier(len(calls) + 1)
+
+    def extract(index, samples, rate):
+        barrier.wait()
+        start = time.perf_counter()
+        results[index] = ToneExtraction(config_data, samples=samples, sample_rate=rate,
+                                        spectrum_batcher=spectrum_batcher).main()
+        latencies[index] = time.perf_counter() - start
+
+    threads = [threading.Thread(target=extract, args=(index, samples, rate))
+               for index, (samples, rate) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start, results
+
+
+def report(name, latencies, wall_time, call_count):
+    latencies_ms = np.array(latencies) * 1000
+    print(f"{name:<10} p50 {np.percentile(latencies_ms, 50):8.1f} ms   p95 {np.percentile(latencies_ms, 95):8.1f} ms"
+          f"   max {latencies_ms.max():8.1f} ms   {call_count / wall_time:7.1f} calls/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="Directory of recordings, cycled through to fill each burst")
+    parser.add_argument("--config", default="etc/config.json", help="Base configuration, defaults are used if missing")
+    parser.add_argument("--set", nargs="*", default=[], help="tone_extraction overrides (key=value)")
+    parser.add_argument("--burst", type=int, default=32, help="Extractions started together")
+    parser.add_argument("--rounds", type=int, default=3, help="Bursts run per mode")
+    parser.add_argument("--max-batch", type=int, default=32, help="SpectrumBatcher max_batch")
+    parser.add_argument("--max-wait-ms", type=float, default=5, help="SpectrumBatcher max_wait_ms")
+    parser.add_argument("--workers", type=int, default=-1, help="SpectrumBatcher scipy.fft workers")
+    args = parser.parse_args()
+
+    base_config = default_config
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as f:
+            base_config = json.load(f)
+    config_data = build_config(base_config, parse_settings(args.set))
+
+    files = sorted(os.path.join(root, name) for root, _, names in os.walk(args.corpus) for name in names
+                   if name.lower().endswith(audio_extensions))
+    if not files:
+        print(f"No recordings found in {args.corpus}")
+        return 1
+
+    decoded = []
+    for path in files:
+        with open(path, 'rb') as f:
+            samples, rate, _ = decode_audio(f, analysis_rate(config_data))
+        decoded.append((samples, rate))
+    calls = [decoded[index % len(decoded)] for index in range(args.burst)]
+    audio_seconds = sum(len(samples) / rate for samples, rate in calls)
+    print(f"{len(files)} recordings, bursts of {args.burst} calls ({audio_seconds:.0f}s of audio), "
+          f"{args.rounds} rounds per mode")
+
+    spectrum_batcher = SpectrumBatcher(args.max_batch, args.max_wait_ms, args.workers)
+    # One untimed burst per mode so imports, FFT plans and the batcher thread are warm
+    run_burst(config_data, calls, None)
+    run_burst(config_data, calls, spectrum_batcher)
+
+    summaries = {}
+    for name, batcher in (("unbatched", None), ("batched", spectrum_batcher)):
+        latencies, wall_time = [], 0.0
+        for _ in range(args.rounds):
+            burst_latencies, burst_time, results = run_burst(config_data, calls, batcher)
+            latencies += burst_latencies
+            wall_time += burst_time
+        summaries[name] = [summarize(result) for result in results]
+        report(name, latencies, wall_time, len(calls) * args.rounds)
+
+    batcher_stats = spectrum_batcher.stats()
+    print(f"Batcher ran {batcher_stats['batches']} batches, {batcher_stats['mean_batch_size']} extractions each")
+    if summaries["unbatched"] != summaries["batched"]:
+        print("Batched and unbatched detections DIFFER")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""Runs tone extraction twice over a corpus of recordings and reports where the results differ.
+
+Used to check that an extraction setting (analysis rate, engine, ...) doesn't change detections, e.g.
+
+    python tools/compare_extraction.py /path/to/corpus --set-a analysis_rate=22050 --set-b analysis_rate=8000
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydub import AudioSegment
+
+from lib.config_handler import default_config
+from lib.tone_extraction_handler import ToneExtraction
+
+audio_extensions = ('.mp3', '.wav', '.m4a')
+
+
+def parse_settings(settings):
+    """Turns ["analysis_rate=8000", "engine=goertzel"] into tone_extraction overrides."""
+    overrides = {}
+    for setting in settings:
+        key, value = setting.split("=", 1)
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+
+def build_config(base_config, overrides):
+    config_data = copy.deepcopy(base_config)
+    config_data["tone_extraction"].update(overrides)
+    return config_data
+
+
+def summarize(results):
+    """Reduces extraction results to what detectors care about, (identity, occurred) per tone."""
+    quick_call, hi_low, long_tone, dtmf = results
+    return {
+        "quick_call": [(tuple(t["exact"]), t["occured"]) for t in quick_call],
+        "hi_low": [("hi_low", t["occurred"]) for t in hi_low],
+        "long": [("long", t["occurred"]) for t in long_tone],
+        "dtmf": [(t["key"], t["occurred"]) for t in dtmf],
+    }
+
+
+def same_detections(tones_a, tones_b, time_tolerance):
+    if len(tones_a) != len(tones_b):
+        return False
+    return all(identity_a == identity_b and abs(occurred_a - occurred_b) <= time_tolerance
+               for (identity_a, occurred_a), (identity_b, occurred_b) in zip(tones_a, tones_b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="Directory of recordings to compare")
+    parser.add_argument("--config", default="etc/config.json", help="Base configuration, defaults are used if missing")
+    parser.add_argument("--set-a", nargs="*", default=[], help="tone_extraction overrides for run A (key=value)")
+    parser.add_argument("--set-b", nargs="*", default=[], help="tone_extraction overrides for run B (key=value)")
+    parser.add_argument("--time-tolerance", type=float, default=0.15, help="Seconds two detections may differ by")
+    args = parser.parse_args()
+
+    base_config = default_config
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as f:
+            base_config = json.load(f)
+
+    config_a = build_config(base_config, parse_settings(args.set_a))
+    config_b = build_config(base_config, parse_settings(args.set_b))
+
+    files = sorted(os.path.join(root, name) for root, _, names in os.walk(args.corpus) for name in names
+                   if name.lower().endswith(audio_extensions))
+
+    differences = 0
+    for path in files:
+        audio_segment = AudioSegment.from_file(path)
+        result_a = summarize(ToneExtraction(config_a, audio_segment).main())
+        result_b = summarize(ToneExtraction(config_b, audio_segment).main())
+        differing = [key for key in result_a if not same_detections(result_a[key], result_b[key], args.time_tolerance)]
+        if differing:
+            differences += 1
+            print(f"DIFFERS {path}")
+            for key in differing:
+                print(f"    {key}: A={result_a[key]} B={result_b[key]}")
+
+    print(f"{len(files)} files compared, {differences} with different detections.")
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())